@@ -34,7 +34,7 @@ for directory in content.files:
 
             # This test is to exclude deleted profiles and defunct directories
             if None != part.get_file(path):
-                profile = stfs.STFS(filename = None, fd = part.open_fd(path))
+                profile = stfs.STFS(filename = None, fd = part.open_fd(path, readahead = partition.DEFAULT_READAHEAD))
 
                 # The account block is always at /Account in the STFS archive
                 # we'll read it in, decode it and then print out the gamertag
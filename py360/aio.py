@@ -0,0 +1,178 @@
+"""
+Asynchronous facade over Partition, STFS and XDBF for services that examine many images at once.
+Every call runs on a pool of threads and returns straight away with a multiprocessing AsyncResult
+(get/wait/ready/successful), an optional callback is run with the result when the call completes.
+Python 2 has no asyncio so nothing here is awaitable, an event loop can poll ready() or use the callbacks.
+Large reads are split along the cluster runs of the file so several cluster reads are in flight at once.
+To use it try something like:
+    pending = aio.open_partition('/mnt/data/201010.bin')
+    part = pending.get()
+    part.read_file('/Content/0000000000000000/FFFE07D1/00010000/ProfileFile', callback = process)
+    for dirpath, dirnames, filenames in part.iter_walk('/'):
+        print dirpath
+"""
+
+import Queue
+from threading import Event
+from multiprocessing.pool import ThreadPool
+from partition import Partition, DEFAULT_CHUNK_SIZE, DEFAULT_READAHEAD
+from stfs import STFS
+from xdbf import XDBF
+
+DEFAULT_THREADS = 4
+DEFAULT_IO_THREADS = 8
+DEFAULT_WALK_QUEUE = 64
+WALK_PUT_TIMEOUT = 0.1 # How often a blocked walk checks whether its consumer has gone away
+
+def open_partition(filename, pool = None, io_pool = None, callback = None, **kwargs):
+    """ Opens (and parses the directory tree of) a partition in the background
+        The AsyncResult's value is an AsyncPartition. Keyword arguments are passed on to Partition,
+        which is made threadsafe unless told otherwise so that reads can run concurrently.
+    """
+    kwargs.setdefault('threadsafe', True)
+    if pool == None:
+        pool = ThreadPool(DEFAULT_THREADS)
+    if io_pool == None:
+        io_pool = ThreadPool(DEFAULT_IO_THREADS)
+    def open_it():
+        return AsyncPartition(Partition(filename, **kwargs), pool, io_pool)
+    return pool.apply_async(open_it, callback = callback)
+
+class AsyncPartition(object):
+    """ Runs the blocking Partition calls on a thread pool
+        Jobs run on pool and the cluster reads they fan out run on io_pool. Keeping the two apart means
+        a job waiting on its reads can never starve the pool that has to perform them.
+        The partition must be threadsafe or memory mapped, otherwise the concurrent reads would share
+        one file pointer and return each other's data, so any other partition is refused with a ValueError.
+    """
+    def __str__(self):
+        return "Async %s" % str(self.partition)
+
+    def __init__(self, partition, pool = None, io_pool = None, chunk_size = DEFAULT_CHUNK_SIZE):
+        if not (partition.threadsafe or partition.mmap != None):
+            raise ValueError("AsyncPartition needs a threadsafe or memory mapped partition: %s" % partition.filename)
+        self.partition = partition
+        self.pool = pool or ThreadPool(DEFAULT_THREADS)
+        self.io_pool = io_pool or ThreadPool(DEFAULT_IO_THREADS)
+        self.chunk_size = chunk_size
+
+    def close(self):
+        """ Stops accepting work and waits for the outstanding calls to finish """
+        for pool in (self.pool, self.io_pool):
+            pool.close()
+        for pool in (self.pool, self.io_pool):
+            pool.join()
+
+    def submit(self, func, args = (), callback = None):
+        """ Runs any blocking call on the job pool """
+        return self.pool.apply_async(func, args, callback = callback)
+
+    def get_file(self, filename, callback = None):
+        """ Looks up a FileObj or Directory, the AsyncResult's value is None if it doesn't exist """
+        return self.submit(self.partition.get_file, (filename,), callback)
+
+    def stat(self, filename, callback = None):
+        """ The FileRecord of a file or directory (size, attributes and FAT times) """
+        def stat_it():
+            fileobj = self.partition.get_file(filename)
+            if fileobj == None:
+                return None
+            return fileobj.fr
+        return self.submit(stat_it, callback = callback)
+
+    def read_pieces(self, extents, size, offset):
+        """ Splits a read along the file's cluster runs into (cluster, length, offset) reads of at most chunk_size """
+        pieces = []
+        for first, count in extents:
+            if size <= 0:
+                break
+            runlen = count << 14L
+            if offset >= runlen:
+                offset -= runlen
+                continue
+            readlen = min(runlen - offset, size)
+            size -= readlen
+            while readlen > 0:
+                chunk = min(readlen, self.chunk_size)
+                pieces.append((first, chunk, offset))
+                offset += chunk
+                readlen -= chunk
+            offset = 0
+        return pieces
+
+    def read_concurrent(self, fileobj, size = -1, offset = 0):
+        """ The blocking half of read_file, the pieces of the read are performed by io_pool """
+        if size < 0:
+            size = max(0, fileobj.fr.fsize - offset)
+        pieces = self.read_pieces(self.partition.load_extents(fileobj), size, offset)
+        if len(pieces) < 2:
+            return self.partition.read_file(fileobj = fileobj, size = size, offset = offset)
+        read = self.partition.read_clusters
+        return "".join(self.io_pool.map(lambda piece: read(*piece), pieces))
+
+    def read_file(self, filename = None, fileobj = None, size = -1, offset = 0, callback = None):
+        """ Reads the contents of a file, the AsyncResult's value is a string """
+        def read_it():
+            f = fileobj
+            if f == None:
+                f = self.partition.get_file(filename)
+            if f == None or f.isDirectory():
+                raise IOError("No such file: %s" % filename)
+            return self.read_concurrent(f, size, offset)
+        return self.submit(read_it, callback = callback)
+
+    def walk(self, path = '/', callback = None):
+        """ Collects every (dirpath, dirnames, filenames) below path, the AsyncResult's value is a list """
+        def walk_it():
+            return list(self.partition.walk_tree(path, threads = DEFAULT_IO_THREADS))
+        return self.submit(walk_it, callback = callback)
+
+    def iter_walk(self, path = '/', queue_size = DEFAULT_WALK_QUEUE):
+        """ A blocking iterator over walk_tree whose walk runs on the job pool
+            It is not an asynchronous iterator (Python 2 has none), each next() waits for the next directory
+            but up to queue_size directories are read ahead of the consumer. Exceptions in the walk are re-raised here.
+            If the consumer stops early (break, an exception or garbage collection) the walk is stopped and
+            its pool thread released.
+        """
+        queue = Queue.Queue(queue_size)
+        stop = Event()
+        done = object()
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout = WALK_PUT_TIMEOUT)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        def walk_it():
+            try:
+                for entry in self.partition.walk_tree(path, threads = DEFAULT_IO_THREADS):
+                    if not put((entry, None)):
+                        return
+                put((done, None))
+            except Exception, e:
+                put((done, e))
+        self.submit(walk_it)
+        try:
+            while True:
+                entry, error = queue.get()
+                if error != None:
+                    raise error
+                if entry is done:
+                    return
+                yield entry
+        finally:
+            stop.set()
+
+    def open_stfs(self, filename, callback = None):
+        """ Parses an STFS container stored on the partition, the AsyncResult's value is an STFS """
+        def open_it():
+            return STFS(filename, fd = self.partition.open_fd(filename, readahead = DEFAULT_READAHEAD))
+        return self.submit(open_it, callback = callback)
+
+    def open_xdbf(self, filename, callback = None):
+        """ Parses a GPD (XDBF) file stored on the partition, the AsyncResult's value is an XDBF """
+        def open_it():
+            return XDBF(filename, fd = self.partition.open_fd(filename, readahead = DEFAULT_READAHEAD))
+        return self.submit(open_it, callback = callback)
@@ -0,0 +1,150 @@
+"""
+A persistent catalog of the STFS containers on an XTAF partition, stored in SQLite.
+Every file on the partition gets a row keyed by its path, containers also get their header fields.
+A refresh only opens files whose directory entry (first cluster, size and modification time) changed
+so questions like which title ids or profiles are on a drive are answered without reparsing headers.
+To use it try something like:
+    part = partition.Partition('/mnt/data/201010.bin')
+    cat = Catalog('201010.py360db')
+    cat.refresh(part)
+    print cat.title_ids()
+"""
+
+import sys
+import sqlite3
+from partition import Partition
+from stfs import STFS, STFS_MAGIC
+from constants import ContentTypes
+
+CATALOG_SUFFIX = '.py360db'
+HEADER_READAHEAD = 0x2000 # A lazy STFS open only needs the first 0x171A bytes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    cluster INTEGER,
+    fsize INTEGER,
+    mtime INTEGER,
+    magic TEXT,
+    content_type INTEGER,
+    content_type_name TEXT,
+    title_id INTEGER,
+    profile_id TEXT,
+    display_name TEXT,
+    content_size INTEGER,
+    allocated_blocks INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_title_id ON files (title_id);
+CREATE INDEX IF NOT EXISTS files_content_type ON files (content_type);
+CREATE INDEX IF NOT EXISTS files_profile_id ON files (profile_id);
+"""
+
+COLUMNS = ("path", "cluster", "fsize", "mtime", "magic", "content_type", "content_type_name", "title_id",
+           "profile_id", "display_name", "content_size", "allocated_blocks")
+
+def file_row(path, fr):
+    """ The catalog row of a file that isn't an STFS container, every header column is None """
+    return [path, fr.cluster, fr.fsize, fr.mdate << 16 | fr.mtime] + [None] * 8
+
+def container_row(part, path, fr):
+    """ Builds a catalog row for a file, the header columns are None if it isn't an STFS container """
+    row = file_row(path, fr)
+    if fr.fsize < 4 or part.read_file(path, size = 4) not in STFS_MAGIC:
+        return row
+    container = STFS(path, fd = part.open_fd(path, readahead = HEADER_READAHEAD), lazy = True)
+    row[4:] = [container.magic,
+               container.content_type,
+               ContentTypes.types.get(container.content_type, "Unknown"),
+               container.title_id,
+               container.profile_id.encode('hex').upper(),
+               container.display_name.decode('utf-16-be', 'replace').split(u'\x00')[0],
+               container.content_size,
+               container.allocated_count]
+    return row
+
+class Catalog(object):
+    """ SQLite backed catalog of the files and STFS containers on a partition
+        Rows are dicts of the COLUMNS, header columns are None for files that aren't containers.
+    """
+    def __str__(self):
+        return "py360 Catalog: %s" % self.filename
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, part, path = '/'):
+        """ Brings the catalog up to date with the files below path on the partition
+            Files whose cluster, size and modification time haven't changed are not read at all.
+            A container that can't be parsed is stored with empty header columns like any other file.
+            Returns the number of files that were (re)read and the number of rows removed.
+        """
+        known = {}
+        prefix = path.rstrip('/') + '/'
+        for row in self.db.execute("SELECT path, cluster, fsize, mtime FROM files"):
+            if row[0].startswith(prefix) or row[0] == path:
+                known[row[0]] = tuple(row[1:])
+
+        updated = 0
+        with self.db:
+            for dirpath, dirnames, filenames in part.walk_tree(path):
+                for name in filenames:
+                    filename = dirpath.rstrip('/') + '/' + name
+                    fr = part.get_file(filename).fr
+                    if known.pop(filename, None) == (fr.cluster, fr.fsize, fr.mdate << 16 | fr.mtime):
+                        continue
+                    try:
+                        row = container_row(part, filename, fr)
+                    except (IOError, AssertionError) as e:
+                        # Still record it so an unchanged broken container isn't reopened on every refresh
+                        sys.stderr.write("Unable to catalog %s: %s\n" % (filename, e))
+                        row = file_row(filename, fr)
+                    self.db.execute("INSERT OR REPLACE INTO files VALUES (%s)" % ", ".join(["?"] * len(COLUMNS)), row)
+                    updated += 1
+            # Anything left in known has been deleted or moved
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(filename,) for filename in known])
+        return updated, len(known)
+
+    def query(self, where = "1", args = ()):
+        """ Returns the container rows matching an SQL condition """
+        cursor = self.db.execute("SELECT %s FROM files WHERE magic IS NOT NULL AND (%s) ORDER BY path" %\
+                                 (", ".join(COLUMNS), where), args)
+        return [dict(zip(COLUMNS, row)) for row in cursor]
+
+    def distinct(self, column):
+        """ The distinct values of a column across the containers """
+        assert column in COLUMNS, "Unknown catalog column"
+        cursor = self.db.execute("SELECT DISTINCT %s FROM files WHERE magic IS NOT NULL ORDER BY %s" % (column, column))
+        return [row[0] for row in cursor]
+
+    def title_ids(self):
+        return self.distinct("title_id")
+
+    def content_types(self):
+        return self.distinct("content_type_name")
+
+    def profile_ids(self):
+        return self.distinct("profile_id")
+
+def main(argv):
+    if len(argv) < 2:
+        print "Usage: catalog.py <xtaf image> [catalog file]"
+        print "Catalogs the STFS containers on the partition (incrementally if the catalog exists)"
+        return
+    filename = argv[1] + CATALOG_SUFFIX
+    if len(argv) > 2:
+        filename = argv[2]
+    cat = Catalog(filename)
+    updated, removed = cat.refresh(Partition(argv[1]))
+    print "Updated %d and removed %d entries in %s" % (updated, removed, filename)
+    for row in cat.query():
+        print "%s\t%s\t%08X\t%s\t%s" % (row["path"], row["content_type_name"], row["title_id"],
+                                        row["profile_id"], row["display_name"].encode('utf-8'))
+    cat.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
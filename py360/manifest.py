@@ -0,0 +1,118 @@
+"""
+Hash every file on an XTAF partition (and every file inside the STFS containers on it) for forensic manifests.
+Each file is streamed once through all the requested digests and files are spread over a pool of threads,
+hashlib releases the GIL while hashing so this scales with the number of threads.
+To use it try something like:
+    part = partition.Partition('/mnt/data/201010.bin', threadsafe = True)
+    write_manifest(hash_partition(part), open('manifest.csv', 'w'))
+"""
+
+import sys
+import csv
+import json
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from partition import Partition, DEFAULT_READAHEAD, DEFAULT_CHUNK_SIZE
+from stfs import STFS, STFS_MAGIC
+
+DEFAULT_ALGORITHMS = ("md5", "sha1", "sha256")
+
+def hash_chunks(chunks, algorithms = DEFAULT_ALGORITHMS):
+    """ Feeds every chunk into one digest per algorithm, returns the total size and the hex digests """
+    hashers = [hashlib.new(name) for name in algorithms]
+    size = 0
+    for chunk in chunks:
+        for h in hashers:
+            h.update(chunk)
+        size += len(chunk)
+    return size, [h.hexdigest() for h in hashers]
+
+def hash_file(part, filename, algorithms = DEFAULT_ALGORITHMS, containers = True):
+    """ Hashes one file on the partition, returns a list of manifest rows
+        If the file is an STFS container (and containers is True) each file inside it gets a row too
+    """
+    fileobj = part.get_file(filename)
+    magic = []
+    def chunks():
+        for chunk in part.iter_file(fileobj = fileobj):
+            if len(magic) == 0:
+                magic.append(chunk[:4].tobytes())
+            yield chunk
+    size, digests = hash_chunks(chunks(), algorithms)
+    rows = [[filename, "", size] + digests]
+
+    if containers and len(magic) > 0 and magic[0] in STFS_MAGIC:
+        try:
+            container = STFS(filename, fd = part.open_fd(filename, readahead = DEFAULT_READAHEAD))
+            for path in sorted(container.allfiles):
+                fl = container.allfiles[path]
+                if not fl.isdirectory:
+                    fd = container.open_fd(path, buffering = 0)
+                    size, digests = hash_chunks(iter(lambda: fd.read(DEFAULT_CHUNK_SIZE), ""), algorithms)
+                    rows.append([path, filename, size] + digests)
+        except (IOError, AssertionError) as e:
+            sys.stderr.write("Unable to hash STFS container %s: %s\n" % (filename, e))
+    return rows
+
+def hash_partition(part, path = '/', algorithms = DEFAULT_ALGORITHMS, threads = 4, containers = True):
+    """ A generator of manifest rows (path, container, size, digests...) for every file below path
+        Rows come back in completion order. Threads > 1 needs a threadsafe or memory mapped partition.
+    """
+    filenames = []
+    for dirpath, dirnames, names in part.walk_tree(path, threads = threads):
+        filenames.extend([dirpath.rstrip('/') + '/' + name for name in names])
+
+    def worker(filename):
+        try:
+            return hash_file(part, filename, algorithms, containers)
+        except (IOError, OSError) as e:
+            sys.stderr.write("Unable to hash %s: %s\n" % (filename, e))
+            return []
+
+    if threads > 1 and (part.threadsafe or part.mmap != None):
+        pool = ThreadPool(threads)
+        try:
+            for rows in pool.imap_unordered(worker, filenames):
+                for row in rows:
+                    yield row
+        finally:
+            pool.terminate()
+    else:
+        for filename in filenames:
+            for row in worker(filename):
+                yield row
+
+def write_manifest(rows, out, format = "csv", algorithms = DEFAULT_ALGORITHMS):
+    """ Writes manifest rows to out as CSV (with a header line) or as JSON lines, returns the row count """
+    fields = ["path", "container", "size"] + list(algorithms)
+    if format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(fields)
+    count = 0
+    for row in rows:
+        if format == "csv":
+            writer.writerow(row)
+        else:
+            out.write(json.dumps(OrderedDict(zip(fields, row))) + "\n")
+        count += 1
+    return count
+
+def main(argv):
+    if len(argv) < 3:
+        print "Usage: manifest.py <xtaf image> <manifest file> [csv|jsonl] [threads]"
+        print "Hashes every file on the partition and inside its STFS containers"
+        return
+    format = "csv"
+    if len(argv) > 3:
+        format = argv[3]
+    threads = 4
+    if len(argv) > 4:
+        threads = int(argv[4])
+    part = Partition(argv[1], threadsafe = True)
+    with open(argv[2], 'w') as out:
+        count = write_manifest(hash_partition(part, threads = threads), out, format)
+    print "Wrote %d rows to %s" % (count, argv[2])
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -7,24 +7,107 @@
     xtafpart = Partition('/mnt/data/201010.bin') 
 """
 
+import io
+import os
+import re
 import sys
 import mmap
+import Queue
 import struct
+import time
+import hashlib
+import xboxtime
+from array import array
 from threading import Lock
+from bisect import bisect_right
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, deque
 from cStringIO import StringIO
 
-# TODO: Optional thread safety
-class XTAFFD(object):
-    """ A File-like object for representing FileObjs """
-    def __init__(self, partition, fileobj):
+DEFAULT_CACHE_CLUSTERS = 1024 # 16MB worth of 16KB clusters
+DEFAULT_EXTENT_CACHE = 4096 # Extent lists remembered in compact mode, where file objects are rebuilt on every lookup
+DEFAULT_CHUNK_SIZE = 0x100000 # Streaming reads are done 64 clusters at a time
+DEFAULT_READAHEAD = 0x100000 # Enough to hold an STFS hash table and the data blocks it describes
+DEFAULT_FD_POOL = 8 # File objects opened on the image so threadsafe readers each get their own file pointer
+INDEX_VERSION = 2 # Bump when the layout of the saved directory index changes
+INDEX_SUFFIX = '.py360idx'
+INDEX_MAGIC = 'PY360IDX'
+INDEX_HEADER_STRUCT = struct.Struct(">8sIQd20sI") # magic, version, image size, mtime, FAT SHA1, record count
+INDEX_RECORD_STRUCT = struct.Struct(">iccBIIHHHHHHI") # parent, FileRecord fields (name length for the name), extent count
+# On disk directory entry: fnlen, attributes, name, cluster, size then creation, access, update date/time pairs
+FILE_RECORD_STRUCT = struct.Struct(">cc42sIIHHHHHH")
+
+class XTAFFD(io.RawIOBase):
+    """ A File-like object for representing FileObjs
+        It is an io.RawIOBase with readinto so it can be wrapped in an io.BufferedReader.
+        The file offset of every cluster run is worked out once so seeks don't walk the extents.
+        Reads smaller than readahead fetch readahead bytes and later reads are served from that window.
+        Each XTAFFD has its own position and window so use one per thread.
+    """
+    def __init__(self, partition, fileobj, readahead=0):
+        super(XTAFFD, self).__init__()
         self.pointer = 0
         self.fileobj = fileobj
         self.partition = partition
+        self.readahead = readahead
+        self.window = bytearray()
+        self.window_start = 0
+        self.extents = partition.load_extents(fileobj)
+        self.run_offsets = [] # File offset that each extent starts at
+        offset = 0
+        for first, count in self.extents:
+            self.run_offsets.append(offset)
+            offset += count << 14L
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read_at(self, buf, offset):
+        """ Fills buf from the file at offset using the run offset map, returns the number of bytes read """
+        run = bisect_right(self.run_offsets, offset) - 1
+        done = 0
+        while done < len(buf) and run < len(self.extents):
+            first, count = self.extents[run]
+            within = offset + done - self.run_offsets[run]
+            readlen = min((count << 14L) - within, len(buf) - done)
+            n = self.partition.read_clusters_into(buf[done:done + readlen], first, within)
+            done += n
+            if n < readlen:
+                break
+            run += 1
+        return done
+
+    def readinto(self, b):
+        view = memoryview(b)
+        length = min(len(view), self.fileobj.fr.fsize - self.pointer)
+        if length <= 0:
+            return 0
+        start = self.pointer - self.window_start
+        if start < 0 or start + length > len(self.window):
+            if length >= self.readahead: # Big reads go straight into the caller's buffer
+                n = self.read_at(view[:length], self.pointer)
+                self.pointer += n
+                return n
+            window = bytearray(min(self.readahead, self.fileobj.fr.fsize - self.pointer))
+            del window[self.read_at(memoryview(window), self.pointer):]
+            self.window = window
+            self.window_start = self.pointer
+            start = 0
+            length = min(length, len(window))
+        view[:length] = memoryview(self.window)[start:start + length]
+        self.pointer += length
+        return length
 
     def read(self, length=-1):
-        buf = self.partition.read_file(fileobj = self.fileobj, size=length, offset=self.pointer)
-        self.pointer += len(buf)
-        return buf
+        if length < 0:
+            length = self.fileobj.fr.fsize - self.pointer
+        buf = bytearray(max(0, min(length, self.fileobj.fr.fsize - self.pointer)))
+        del buf[self.readinto(buf):]
+        return str(buf)
 
     def seek(self, offset, whence=0):
         if whence == 0:
@@ -32,80 +115,459 @@ class XTAFFD(object):
         if whence == 1:
             self.pointer = self.pointer + offset
         if whence == 2:
-            self.pointer = self.fileobj.fr.fsize - offset
+            if offset < 0: # The io convention
+                self.pointer = self.fileobj.fr.fsize + offset
+            else: # Kept for older callers that count back from the end with a positive offset
+                self.pointer = self.fileobj.fr.fsize - offset
 
         if self.pointer > self.fileobj.fr.fsize:
             self.pointer = self.fileobj.fr.fsize
         if self.pointer < 0:
             self.pointer = 0
+        return self.pointer
 
     def tell(self):
         return self.pointer
 
+class ClusterCache(object):
+    """ A size bounded least recently used cache of whole clusters
+        hits, misses and evictions count what the cache has done since it was created
+    """
+    def __str__(self):
+        return "XTAF Cluster Cache: %d/%d clusters, %d hits, %d misses, %d evictions" %\
+               (len(self.clusters), self.size, self.hits, self.misses, self.evictions)
+
+    def __init__(self, size=DEFAULT_CACHE_CLUSTERS):
+        self.size = size
+        self.clusters = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, cluster):
+        """ Returns the cached cluster data (marking it recently used) or None """
+        with self.lock:
+            data = self.clusters.pop(cluster, None)
+            if data == None:
+                self.misses += 1
+                return None
+            self.clusters[cluster] = data
+            self.hits += 1
+            return data
+
+    def put(self, cluster, data):
+        """ Stores a cluster, evicting the least recently used clusters when full """
+        with self.lock:
+            self.clusters.pop(cluster, None)
+            self.clusters[cluster] = data
+            while len(self.clusters) > self.size:
+                self.clusters.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.clusters.clear()
+
+class FilePool(object):
+    """ A pool of file objects open on the same image so that concurrent readers never share a file pointer
+        Files are opened lazily, up to size of them, and a reader only waits when all of them are busy
+    """
+    def __init__(self, filename, size=DEFAULT_FD_POOL):
+        self.filename = filename
+        self.size = size
+        self.opened = 0
+        self.idle = Queue.LifoQueue()
+        self.lock = Lock()
+
+    def acquire(self):
+        """ Takes an idle file object, opening a new one if the pool isn't full yet """
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            fd = None
+            with self.lock:
+                if self.opened < self.size:
+                    self.opened += 1
+                    fd = open(self.filename, 'rb')
+            if fd == None:
+                fd = self.idle.get()
+            return fd
+
+    def pread(self, offset, length):
+        """ Reads length bytes at offset without disturbing any other reader """
+        fd = self.acquire()
+        try:
+            fd.seek(offset)
+            return fd.read(length)
+        finally:
+            self.idle.put(fd)
+
+    def preadinto(self, buf, offset):
+        """ Fills buf from offset without disturbing any other reader, returns the number of bytes read """
+        fd = self.acquire()
+        try:
+            fd.seek(offset)
+            return fd.readinto(buf)
+        finally:
+            self.idle.put(fd)
+
+def find_segments(filename):
+    """ Returns the segment filenames of a split raw image or None for a single image
+        filename is either a list of segments or the first segment (IMAGE.001) and the
+        rest (IMAGE.002, IMAGE.003...) are found by counting up until one is missing.
+        Only a suffix of three or more digits is detected, so separate images named IMAGE.1 and IMAGE.2
+        are left alone, and every segment but the last must be the same size as the first.
+    """
+    if isinstance(filename, (list, tuple)):
+        return list(filename)
+    match = re.match(r"^(.*\.)(0{2,}1)$", filename)
+    if match == None:
+        return None
+    prefix, digits = match.groups()
+    segments = []
+    while True:
+        name = "%s%0*d" % (prefix, len(digits), len(segments) + 1)
+        if not os.path.exists(name):
+            break
+        segments.append(name)
+    if len(segments) < 2:
+        return None
+    sizes = [os.path.getsize(name) for name in segments]
+    if len(set(sizes[:-1])) != 1 or sizes[-1] > sizes[0]:
+        print "Not joining %s: its segments are not evenly sized" % filename
+        return None
+    return segments
+
+class SplitImage(object):
+    """ A read only file-like object presenting the segments of a split raw image as one address space
+        Image offsets are mapped to (segment, offset) with a bisect of the segment start offsets.
+        Like Partition the segments can be memory mapped, and threadsafe reads go through a FilePool
+        per segment. The read/seek/tell interface is not threadsafe.
+    """
+    def __str__(self):
+        return "Split Image: %s (%d segments)" % (self.filenames[0], len(self.filenames))
+
+    def __init__(self, filenames, use_mmap=False, threadsafe=False, fd_pool_size=DEFAULT_FD_POOL):
+        self.filenames = filenames
+        self.threadsafe = threadsafe
+        self.fds = [open(name, 'rb') for name in filenames]
+        self.starts = []
+        self.size = 0
+        self.mtime = 0
+        for fd in self.fds:
+            st = os.fstat(fd.fileno())
+            self.starts.append(self.size)
+            self.size += st.st_size
+            self.mtime = max(self.mtime, st.st_mtime)
+        self.maps = None
+        self.pools = None
+        if use_mmap:
+            self.maps = [mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) for fd in self.fds]
+        elif threadsafe:
+            self.pools = [FilePool(name, fd_pool_size) for name in filenames]
+        self.pointer = 0
+
+    def pieces(self, offset, length):
+        """ Splits a range of the image into (segment, offset in segment, length) pieces """
+        segment = bisect_right(self.starts, offset) - 1
+        while length > 0 and segment < len(self.fds):
+            if segment + 1 < len(self.starts):
+                end = self.starts[segment + 1]
+            else:
+                end = self.size
+            n = min(end - offset, length)
+            if n > 0:
+                yield segment, offset - self.starts[segment], n
+                offset += n
+                length -= n
+            segment += 1
+
+    def read_segment(self, segment, offset, length):
+        if self.maps != None:
+            return self.maps[segment][offset:offset + length]
+        if self.pools != None:
+            return self.pools[segment].pread(offset, length)
+        fd = self.fds[segment]
+        fd.seek(offset)
+        return fd.read(length)
+
+    def pread(self, offset, length):
+        """ Reads length bytes at an image offset, joining pieces when the range crosses segments """
+        pieces = [self.read_segment(segment, within, n) for segment, within, n in self.pieces(offset, length)]
+        if len(pieces) == 1:
+            return pieces[0]
+        return "".join(pieces)
+
+    def preadinto(self, buf, offset):
+        """ Fills buf (a writable memoryview) from an image offset, returns the number of bytes read """
+        done = 0
+        for segment, within, n in self.pieces(offset, len(buf)):
+            if self.pools != None:
+                got = self.pools[segment].preadinto(buf[done:done + n], within)
+            elif self.maps != None:
+                data = self.maps[segment][within:within + n]
+                got = len(data)
+                buf[done:done + got] = data
+            else:
+                fd = self.fds[segment]
+                fd.seek(within)
+                got = fd.readinto(buf[done:done + n])
+            done += got
+            if got < n:
+                break
+        return done
+
+    def view(self, offset, length):
+        """ A zero-copy buffer of a mapped segment if the range is inside one, otherwise a string """
+        pieces = list(self.pieces(offset, length))
+        if self.maps != None and len(pieces) == 1:
+            segment, within, n = pieces[0]
+            return buffer(self.maps[segment], within, n)
+        return self.pread(offset, length)
+
+    def read(self, length=-1):
+        if length < 0:
+            length = self.size - self.pointer
+        buf = self.pread(self.pointer, length)
+        self.pointer += len(buf)
+        return buf
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pointer = offset
+        if whence == 1:
+            self.pointer += offset
+        if whence == 2:
+            self.pointer = self.size + offset
+        return self.pointer
+
+    def tell(self):
+        return self.pointer
+
+def safe_component(name):
+    """ Whether a directory entry name read from an image can be used as one path component on disk """
+    return name not in ('', '.', '..') and '/' not in name and os.sep not in name and '\x00' not in name
+
 class FileRecord(object):
     """FileRecord is straight off of the disk (but with everything in host byte order)"""
+    fields = ("fnsize", "attribute", "filename", "cluster", "fsize", "mtime", "mdate", "ctime", "cdate", "atime", "adate")
+    __slots__ = fields
+
     def __str__(self):
         return "XTAF FileRecord: %s" % self.filename
 
-    def __init__(self, **kwargs):
-        self.fnsize = kwargs["fnsize"]
-        self.attribute = kwargs["attribute"]
-        self.filename = kwargs["filename"]
-        self.cluster = kwargs["cluster"]
-        self.fsize = kwargs["fsize"]
-        self.mtime = kwargs["mtime"]
-        self.mdate = kwargs["mdate"]
-        self.ctime = kwargs["ctime"]
-        self.cdate = kwargs["cdate"]
-        self.atime = kwargs["atime"]
-        self.adate = kwargs["adate"]
+    def __init__(self, fnsize, attribute, filename, cluster, fsize, mtime, mdate, ctime, cdate, atime, adate):
+        self.fnsize = fnsize
+        self.attribute = attribute
+        self.filename = filename
+        self.cluster = cluster
+        self.fsize = fsize
+        self.mtime = mtime
+        self.mdate = mdate
+        self.ctime = ctime
+        self.cdate = cdate
+        self.atime = atime
+        self.adate = adate
 
     def isDirectory(self):
         if self.fsize == 0:
             return True
         return False
 
+def clusters_to_extents(clusters):
+    """ Compresses a list of cluster numbers into a list of (first cluster, cluster count) runs """
+    extents = []
+    for cl in clusters:
+        if len(extents) > 0 and extents[-1][0] + extents[-1][1] == cl:
+            extents[-1] = (extents[-1][0], extents[-1][1] + 1)
+        else:
+            extents.append((cl, 1))
+    return extents
+
 class FileObj(object):
-    """ FileObj is a container with a FileRecord and a list of clusters """
+    """ FileObj is a container with a FileRecord and a list of cluster extents
+        Each extent is a (first cluster, cluster count) tuple for a run of consecutive clusters
+    """
+    __slots__ = ("fr", "extents", "fullpath")
+
     def __str__(self):
         return "XTAF File: %s" % self.fr
 
-    def __init__(self, fr, clusters):
+    def __init__(self, fr, extents):
         self.fr = fr
-        self.clusters = clusters
+        self.extents = extents
+
+    def get_cluster_list(self):
+        """ The flat list of cluster numbers described by the extents """
+        clusters = []
+        for first, count in self.extents:
+            clusters.extend(xrange(first, first + count))
+        return clusters
+
+    def set_cluster_list(self, clusters):
+        self.extents = clusters_to_extents(clusters)
+
+    clusters = property(get_cluster_list, set_cluster_list)
 
     def isDirectory(self):
         return False
 
 class Directory(FileObj):
     """ Directory is a FileObj with a dict of FileObj """
+    __slots__ = ("files", "root")
+
     def __str__(self):
         return "%s (Directory)" % (super(Directory, self).__str__())
 
-    def __init__(self, fr, clusters):
-        super(Directory, self).__init__(fr, clusters)
+    def __init__(self, fr, extents):
+        super(Directory, self).__init__(fr, extents)
         self.files = {}
         self.root = False
 
     def isDirectory(self):
         return True
 
+class FileTable(object):
+    """ A compact, array backed table of every file record on a partition
+        Each column is an array with one entry per file and names live in a single character pool.
+        Row 0 is the root directory. The children of a directory are stored in consecutive rows
+        (child_start, child_count) sorted by name so a path lookup is a binary search per component.
+    """
+    def __str__(self):
+        return "XTAF File Table: %d files, %d bytes of names" % (len(self.parent), len(self.names))
+
+    def __init__(self, root_cluster):
+        self.parent = array('i')
+        self.name_offset = array('I')
+        self.name_length = array('B')
+        self.fnsize = array('B')
+        self.attribute = array('B')
+        self.cluster = array('I')
+        self.fsize = array('I')
+        self.mtime = array('H')
+        self.mdate = array('H')
+        self.ctime = array('H')
+        self.cdate = array('H')
+        self.atime = array('H')
+        self.adate = array('H')
+        self.child_start = array('i')
+        self.child_count = array('i')
+        self.names = array('c')
+        self.append(-1, FileRecord('\x00', '\x00', '', root_cluster, 0, 0, 0, 0, 0, 0, 0))
+
+    def append(self, parent, fr):
+        """ Adds a row for fr below the parent row and returns its row number """
+        self.parent.append(parent)
+        self.name_offset.append(len(self.names))
+        self.name_length.append(len(fr.filename))
+        self.names.fromstring(fr.filename)
+        self.fnsize.append(ord(fr.fnsize))
+        self.attribute.append(ord(fr.attribute))
+        self.cluster.append(fr.cluster)
+        self.fsize.append(fr.fsize)
+        self.mtime.append(fr.mtime)
+        self.mdate.append(fr.mdate)
+        self.ctime.append(fr.ctime)
+        self.cdate.append(fr.cdate)
+        self.atime.append(fr.atime)
+        self.adate.append(fr.adate)
+        self.child_start.append(-1)
+        self.child_count.append(0)
+        return len(self.parent) - 1
+
+    def add_children(self, row, records):
+        """ Stores the file records of the directory in row, children must be added one directory at a time """
+        records = sorted(records, key=lambda fr: fr.filename)
+        self.child_start[row] = len(self.parent)
+        self.child_count[row] = len(records)
+        return [self.append(row, fr) for fr in records]
+
+    def name(self, row):
+        offset = self.name_offset[row]
+        return self.names[offset:offset + self.name_length[row]].tostring()
+
+    def isDirectory(self, row):
+        return self.fsize[row] == 0
+
+    def children(self, row):
+        start = self.child_start[row]
+        return xrange(start, start + self.child_count[row])
+
+    def get_record(self, row):
+        """ Rebuilds the FileRecord of a row """
+        return FileRecord(chr(self.fnsize[row]), chr(self.attribute[row]), self.name(row), self.cluster[row],\
+                          self.fsize[row], self.mtime[row], self.mdate[row], self.ctime[row], self.cdate[row],\
+                          self.atime[row], self.adate[row])
+
+    def lookup(self, row, name):
+        """ Binary search of the children of row for name, returns the child row or -1 """
+        lo = self.child_start[row]
+        hi = lo + self.child_count[row]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.child_start[row] + self.child_count[row] and self.name(lo) == name:
+            return lo
+        return -1
+
+    def find(self, path):
+        """ Returns the row of a full path or -1 """
+        row = 0
+        if path == '/':
+            return row
+        for component in path[1:].split('/'):
+            row = self.lookup(row, component)
+            if row == -1:
+                break
+        return row
+
+    def path(self, row):
+        """ Rebuilds the full path of a row from its parents """
+        components = []
+        while row > 0:
+            components.append(self.name(row))
+            row = self.parent[row]
+        components.append('')
+        components.reverse()
+        return "/".join(components) or '/'
+
 class Partition(object):
     """
         Main class representing the partition
         The allfiles member has a dictionary of all the files in the partition
         The rootfile member contains a directory object that represents the root directory 
+        When created with compact = True the whole partition is parsed into a FileTable (the filetable member)
+        instead, allfiles is left empty and get_file/walk build file objects from the table on demand
     """
     def __str__(self):
         return "XTAF Partition: %s" % self.filename
 
-    def __init__(self, filename, threadsafe=False, precache=False):
+    def __init__(self, filename, threadsafe=False, precache=False, use_mmap=False, cache_size=0,\
+                 fd_pool_size=DEFAULT_FD_POOL, index=False, index_dir=None, compact=False):
+        """ cache_size is the number of clusters kept in an LRU cluster cache (0 disables it)
+            threadsafe reads go through a FilePool of up to fd_pool_size files open on the image so they never serialise
+            filename can also be a list of segments or the first segment (IMAGE.001) of a split raw image
+            index loads the whole directory tree from an index file next to the image (or in index_dir),
+            doing a full precache and writing the index when it is missing or stale
+            compact parses the whole partition into an array backed FileTable rather than allfiles
+        """
+        self.segments = find_segments(filename)
+        if self.segments != None:
+            filename = self.segments[0]
         self.filename = filename
         self.threadsafe = threadsafe
         self.SIZE_OF_FAT_ENTRIES = 4
 
         #TODO: Error checking
-        fd = open(filename, 'r') # The 'r' is very imporant
+        if self.segments != None: # Split images are read through one virtual address space
+            fd = SplitImage(self.segments, use_mmap, threadsafe, fd_pool_size)
+            use_mmap = False
+        else:
+            fd = open(filename, 'r') # The 'r' is very imporant
         if fd.read(4) != 'XTAF':
             start = 0x130EB0000L # TODO: Improve this detection mechanism
         else:
@@ -117,12 +579,23 @@ class Partition(object):
         size = end - rootdir
         fatsize = size >> 14L
 
-        # This doesn't work because unlike the C version of mmap you can't give it a 64 bit offset
-        #fatfd = mmap.mmap(fd.fileno(), fatsize, mmap.PROT_READ, mmap.PROT_READ, offset=fat)
-        # So we have to keep the whole FAT in memory during processing
-        fd.seek(fat, 0)
-        fatdata = fd.read(fatsize * 4)
-        fd.seek(0, 0)
+        # Mapping a window at a 64 bit offset doesn't work but mapping the whole image from 0 does.
+        # With the image mapped clusters are sliced straight out of the page cache (no seek/read calls)
+        if use_mmap:
+            imagemap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            fatdata = imagemap[fat:fat + fatsize * 4]
+        else:
+            # Without the map we have to keep the whole FAT in memory during processing
+            imagemap = None
+            fd.seek(fat, 0)
+            fatdata = fd.read(fatsize * 4)
+            fd.seek(0, 0)
+
+        # Decode the FAT once into host byte order so chains can be followed by indexing
+        fattable = array('I')
+        fattable.fromstring(fatdata[:len(fatdata) - len(fatdata) % 4])
+        if sys.byteorder == 'little':
+            fattable.byteswap()
 
         # Setup internal variables
         self.root_dir_cluster = 1
@@ -132,35 +605,81 @@ class Partition(object):
         self.size = size
         self.fat_num = fatsize
         self.fd = fd
+        self.mmap = imagemap
         self.fat_data = fatdata # <- FAT is in BIG ENDIAN
+        self.fat_table = fattable # <- The same FAT decoded to host byte order, one entry per cluster
         self.allfiles = {}
-        self.lock = Lock()
+        self.lock = Lock() # Serialises directory parsing when threadsafe
+        if threadsafe and imagemap == None and self.segments == None:
+            self.fdpool = FilePool(filename, fd_pool_size)
+        else:
+            self.fdpool = None
+        if cache_size > 0:
+            self.cache = ClusterCache(cache_size)
+        else:
+            self.cache = None
         #self.rootfile = self.parse_directory()
-        self.rootfile = self.init_root_directory(recurse = precache)
+        self.filetable = None
+        self.extent_cache = None
+        if compact:
+            self.extent_cache = ClusterCache(DEFAULT_EXTENT_CACHE) # Keyed by first cluster rather than cluster data
+            self.filetable = self.build_file_table()
+            self.rootfile = self.table_fileobj(0, '/')
+        elif index:
+            indexfile = self.index_filename(index_dir)
+            self.rootfile = self.load_index(indexfile)
+            if self.rootfile == None: # Missing or stale, parse everything and save it for next time
+                self.rootfile = self.init_root_directory(recurse = True)
+                self.save_index(indexfile)
+        else:
+            self.rootfile = self.init_root_directory(recurse = precache)
 
-    def read_cluster(self, cluster, length=0x4000, offset=0L):
-        """ Given a cluster number returns that cluster """
+    def read_cluster(self, cluster, length=0x4000, offset=0L, view=False):
+        """ Given a cluster number returns that cluster
+            If the image is memory mapped and view is True a zero-copy buffer of the map is returned
+        """
         if length + offset <= 0x4000: #Sanity check
-            diskoffset = (cluster - 1 << 14L) + self.root_dir + offset
-            # Thread safety is optional because the extra function calls are a large burden
-            if self.threadsafe:
-                self.lock.acquire() 
+            if self.cache != None:
+                data = self.cache.get(cluster)
+                if data == None:
+                    data = self.read_clusters(cluster, 0x4000)
+                    self.cache.put(cluster, data)
+                if view:
+                    return buffer(data, offset, length)
+                if offset == 0 and length == len(data):
+                    return data
+                return data[offset:offset + length]
+            return self.read_clusters(cluster, length, offset, view)
+        else:
+            return ""
 
-            try:
-                self.fd.seek(diskoffset)
-                buf = self.fd.read(length)
-            except IOError:
-                buf = ""
+    def read_clusters(self, cluster, length, offset=0L, view=False):
+        """ Reads length bytes from a run of consecutive clusters starting at cluster in one I/O """
+        diskoffset = (cluster - 1 << 14L) + self.root_dir + offset
+        if self.segments != None:
+            if view:
+                return self.fd.view(diskoffset, length)
+            return self.fd.pread(diskoffset, length)
+        if self.mmap != None: # Slicing the map needs neither the lock nor the file pointer
+            if view:
+                return buffer(self.mmap, diskoffset, length)
+            return self.mmap[diskoffset:diskoffset + length]
 
+        try:
+            # Thread safety is optional, pooled reads leave the shared file pointer alone
             if self.threadsafe:
-                self.lock.release()
-            return buf
-        else:
+                return self.fdpool.pread(diskoffset, length)
+            self.fd.seek(diskoffset)
+            return self.fd.read(length)
+        except (IOError, OSError):
             return ""
 
-    #TODO: Refactor into something smaller
-    def read_file(self, filename=None, fileobj=None, size=-1, offset=0):
-        """ Reads an entire file given a filename or fileobj """
+    def read_file(self, filename=None, fileobj=None, size=-1, offset=0, view=False):
+        """ Reads an entire file given a filename or fileobj
+            Each run of consecutive clusters is fetched with a single read.
+            If the image is memory mapped, view is True and the requested range is inside
+            one run a zero-copy buffer of the map is returned instead of a string
+        """
         #TODO: Error checking
         if not fileobj: 
             fileobj = self.get_file(filename)
@@ -171,58 +690,285 @@ class Partition(object):
             else:
                 size = fileobj.fr.fsize # Read the whole file (skip the slack space)
 
-        if len(fileobj.clusters) == 0: # Initialise cluster list if necessary
-            fileobj.clusters = self.get_clusters(fileobj.fr)
-            if len(fileobj.clusters) == 0: # Check the return of get_clusters
-                print "Reading Empty File"
-                return ""
+        if len(self.load_extents(fileobj)) == 0: # Check the return of get_extents
+            print "Reading Empty File"
+            return ""
+
+        return self.read_extents(fileobj.extents, size, offset, view, cached = fileobj.isDirectory())
+
+    def load_extents(self, fileobj):
+        """ Initialises the extents of a fileobj from the FAT if necessary and returns them """
+        if len(fileobj.extents) == 0:
+            fileobj.extents = self.cached_extents(fileobj.fr)
+        return fileobj.extents
 
-        clusters_to_skip = offset // 0x4000
-        offset %= 0x4000
-        buf = StringIO() 
+    def cached_extents(self, fr):
+        """ get_extents through the extent cache when there is one
+            A chain depends only on its first cluster so compact mode, which builds a fresh fileobj for every
+            get_file, only follows the FAT once for each recently used file.
+        """
+        if self.extent_cache == None or fr.cluster == 0:
+            return self.get_extents(fr)
+        extents = self.extent_cache.get(fr.cluster)
+        if extents == None:
+            extents = self.get_extents(fr)
+            self.extent_cache.put(fr.cluster, extents)
+        return extents
+
+    def read_clusters_into(self, buf, cluster, offset=0L):
+        """ Fills buf (a writable memoryview) from a run of consecutive clusters starting at cluster
+            Returns the number of bytes read, only short at the end of the image or on an error
+        """
+        diskoffset = (cluster - 1 << 14L) + self.root_dir + offset
         try:
-            readlen = min(0x4000, size)
-            buf.write(self.read_cluster(fileobj.clusters[clusters_to_skip], readlen, offset))
+            if self.segments != None:
+                return self.fd.preadinto(buf, diskoffset)
+            if self.mmap != None:
+                data = self.mmap[diskoffset:diskoffset + len(buf)]
+            elif self.threadsafe:
+                return self.fdpool.preadinto(buf, diskoffset)
+            else:
+                self.fd.seek(diskoffset)
+                return self.fd.readinto(buf)
+        except (IOError, OSError):
+            return 0
+        buf[:len(data)] = data
+        return len(data)
+
+    def readinto_file(self, buf, filename=None, fileobj=None, offset=0):
+        """ Fills buf (a bytearray or writable memoryview) with the file's data starting at offset.
+            Returns the number of bytes read which is only less than len(buf) at the end of the file.
+            Each run of consecutive clusters is read straight into buf, no intermediate strings are built.
+        """
+        if not fileobj: 
+            fileobj = self.get_file(filename)
+
+        if fileobj.isDirectory():
+            size = 2**32
+        else:
+            size = fileobj.fr.fsize - offset
+        view = memoryview(buf)
+        wanted = max(0, min(len(view), size))
+        done = 0
+        for first, count in self.load_extents(fileobj):
+            if done >= wanted:
+                break
+            runlen = count << 14L
+            if offset >= runlen: # Skip whole runs before the requested offset
+                offset -= runlen
+                continue
+            readlen = min(runlen - offset, wanted - done)
+            n = self.read_clusters_into(view[done:done + readlen], first, offset)
+            done += n
+            if n < readlen:
+                break
+            offset = 0
+        return done
+
+    def iter_file(self, filename=None, fileobj=None, chunk_size=DEFAULT_CHUNK_SIZE, size=-1, offset=0):
+        """ A generator that streams a file (or size bytes of it from offset) in chunk_size pieces.
+            Every chunk is a memoryview of the same reusable buffer so memory use doesn't depend on
+            the file size. A chunk is only valid until the next one is requested.
+        """
+        if not fileobj: 
+            fileobj = self.get_file(filename)
+
+        if size == -1:
+            size = fileobj.fr.fsize - offset
+        view = memoryview(bytearray(min(chunk_size, max(size, 0))))
+        while size > 0:
+            n = self.readinto_file(view[:min(len(view), size)], fileobj = fileobj, offset = offset)
+            if n == 0:
+                break
+            yield view[:n]
+            offset += n
+            size -= n
+
+    def read_extents(self, extents, size, offset=0, view=False, cached=False):
+        """ Reads size bytes at offset from a list of (first cluster, cluster count) runs
+            Reads that fit in one cluster (and all reads if cached is True) go through the cluster cache
+        """
+        pieces = []
+        for first, count in extents:
+            if size <= 0:
+                break # If we're finished, stop reading runs
+            runlen = count << 14L
+            if offset >= runlen: # Skip whole runs before the requested offset
+                offset -= runlen
+                continue
+            readlen = min(runlen - offset, size)
+            if self.cache != None and (cached or offset + readlen <= 0x4000):
+                # Directories and small reads (such as file headers) go through the cluster cache
+                cl = first + (offset >> 14L)
+                offset &= 0x3FFF
+                remaining = readlen
+                while remaining > 0:
+                    chunk = min(0x4000 - offset, remaining)
+                    pieces.append(self.read_cluster(cl, chunk, offset))
+                    remaining -= chunk
+                    cl += 1
+                    offset = 0
+            else:
+                pieces.append(self.read_clusters(first, readlen, offset, view))
             size -= readlen
-            for cl in fileobj.clusters[clusters_to_skip+1:]:
-                if size <= 0:
-                    break # If we're finished, stop reading clusters
-                readlen = min(0x4000, size)
-                buf.write(self.read_cluster(cl, readlen, 0))
-                size -= readlen
-            return buf.getvalue()
-        except IndexError:
-            print "Read overflow?", len(fileobj.clusters), clusters_to_skip
-            return buf.getvalue()
+            offset = 0
+
+        if len(pieces) == 0:
+            if size > 0:
+                print "Read overflow?", len(extents), offset
+            return ""
+        if len(pieces) == 1:
+            return pieces[0]
+        return "".join([str(piece) for piece in pieces])
 
     def get_clusters(self, fr):
-        """ Builds a list of the clusters a file hash by parsing the FAT """
+        """ Builds a list of the clusters a file has by following the decoded FAT """
+        clusters = []
+        for first, count in self.get_extents(fr):
+            clusters.extend(xrange(first, first + count))
+        return clusters
+
+    def get_extents(self, fr):
+        """ Builds the list of (first cluster, cluster count) runs of a file by following the decoded FAT """
         if fr.cluster == 0:
             print "Empty file"
             return []
-        clusters = [fr.cluster]
-        cl = 0x0
-        cl = fr.cluster
-        cldata = ''
-        while cl & 0xFFFFFFF != 0xFFFFFFF:
-            cl_off = cl * self.SIZE_OF_FAT_ENTRIES 
-            cldata = self.fat_data[cl_off:cl_off + self.SIZE_OF_FAT_ENTRIES]
-            if len(cldata) == 4:
-                cl = struct.unpack(">I", cldata)[0] 
-                if cl & 0xFFFFFFF != 0xFFFFFFF:
-                    clusters.append(cl)
-            else:
+        fat = self.fat_table
+        fatlen = len(fat)
+        extents = []
+        first = cl = fr.cluster
+        count = 1
+        total = 1
+        while True:
+            if cl >= fatlen or total > fatlen: # Off the end of the FAT or a looping chain
                 if fr.filename[0] != '~':
-                    print "get_clusters fat offset warning %s %x vs %x, %x" %\
-                          (fr.filename, cl_off, len(self.fat_data), len(cldata))
-                cl = 0xFFFFFFF
-        return clusters
+                    print "get_extents fat offset warning %s %x vs %x" % (fr.filename, cl, fatlen)
+                break
+            nextcl = fat[cl]
+            if nextcl & 0xFFFFFFF == 0xFFFFFFF:
+                break
+            if nextcl == cl + 1:
+                count += 1
+            else:
+                extents.append((first, count))
+                first = nextcl
+                count = 1
+            cl = nextcl
+            total += 1
+        extents.append((first, count))
+        return extents
 
-    def open_fd(self, filename):
+    def extract_file(self, fileobj, outpath):
+        """ Copies one file out of the partition to outpath keeping its FAT timestamps
+            The file is streamed through iter_file. Returns the bytes written.
+        """
+        fr = fileobj.fr
+        with open(outpath, 'wb') as out:
+            written = 0
+            for chunk in self.iter_file(fileobj = fileobj):
+                out.write(chunk)
+                written += len(chunk)
+        os.utime(outpath, (xboxtime.cached_fat2unixtime(fr.atime, fr.adate), xboxtime.cached_fat2unixtime(fr.mtime, fr.mdate)))
+        return written
+
+    def extract(self, outdir, path = '/', threads = 4, deleted = False, progress = sys.stderr):
+        """ Extracts every file below path into outdir, recreating the directory tree
+            Files are written by a pool of threads (a threadsafe or memory mapped partition is needed for
+            threads > 1) and directories get their FAT timestamps once their contents are written.
+            Deleted (~) entries are skipped unless deleted is True. Progress and throughput are written
+            to progress (unless it is None). Returns the number of files and bytes extracted.
+            Names come from an untrusted image so entries that aren't a single safe path component
+            or that would resolve outside outdir are skipped (and reported to progress), as are files
+            that fail to extract.
+        """
+        top = path.rstrip('/')
+        root = os.path.realpath(outdir)
+        def inside(target):
+            real = os.path.realpath(target)
+            return real == root or real.startswith(root + os.sep)
+        def skip(name, dirpath):
+            if progress != None:
+                progress.write("Skipping unsafe name %r in %s\n" % (name, dirpath))
+
+        dirs = []
+        files = []
+        for dirpath, dirnames, filenames in self.walk_tree(path, threads = threads):
+            for name in [name for name in dirnames + filenames if not safe_component(name)]:
+                skip(name, dirpath)
+            dirnames[:] = [name for name in dirnames if safe_component(name) and (deleted or name[0] != '~')]
+            filenames = [name for name in filenames if safe_component(name) and (deleted or name[0] != '~')]
+            components = [name for name in dirpath[len(top):].split('/') if name != '']
+            target = os.path.join(outdir, *components)
+            if not all([safe_component(name) for name in components]) or not inside(target):
+                skip(dirpath, dirpath)
+                continue
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            dirs.append((dirpath, target))
+            for name in filenames:
+                outpath = os.path.join(target, name)
+                if inside(outpath):
+                    files.append((dirpath.rstrip('/') + '/' + name, outpath))
+                else:
+                    skip(name, dirpath)
+
+        start = time.time()
+        last = start
+        done = 0
+        failed = 0
+        total = 0
+        if threads > 1 and (self.threadsafe or self.mmap != None):
+            pool = ThreadPool(threads)
+            results = pool.imap_unordered(self.extract_entry, files)
+        else:
+            pool = None
+            results = (self.extract_entry(entry) for entry in files)
+        try:
+            for written, error in results:
+                done += 1
+                total += written
+                if error != None:
+                    failed += 1
+                    if progress != None:
+                        progress.write("Error extracting %s: %s\n" % error)
+                if progress != None and time.time() - last >= 1:
+                    last = time.time()
+                    progress.write("Extracted %d/%d files, %.1f MB at %.1f MB/s\n" %\
+                                   (done, len(files), total / 1048576.0, total / 1048576.0 / (last - start)))
+        finally:
+            if pool != None:
+                pool.terminate()
+
+        for dirpath, target in reversed(dirs): # Deepest first so writing files doesn't change the times again
+            fr = self.get_file(dirpath).fr
+            if fr != None:
+                os.utime(target, (xboxtime.cached_fat2unixtime(fr.atime, fr.adate), xboxtime.cached_fat2unixtime(fr.mtime, fr.mdate)))
+        if progress != None:
+            elapsed = max(time.time() - start, 0.001)
+            progress.write("Extracted %d files, %.1f MB in %.1fs (%.1f MB/s)\n" %\
+                           (done - failed, total / 1048576.0, elapsed, total / 1048576.0 / elapsed))
+        return done - failed, total
+
+    def extract_entry(self, entry):
+        """ Extracts one (partition path, output path) pair for extract
+            Returns the bytes written and None, or 0 and (filename, error) for extract to report
+        """
+        filename, outpath = entry
+        try:
+            return self.extract_file(self.get_file(filename), outpath), None
+        except (IOError, OSError) as e:
+            return 0, (filename, e)
+
+    def open_fd(self, filename, readahead=0, buffering=0):
+        """ Return an XTAFFD object for a file
+            readahead is the XTAFFD read ahead window and buffering > 0 wraps it in an io.BufferedReader
+        """
         f = self.get_file(filename)
-        """ Return an XTAFFD object for a file """
         if f != None:
-            return XTAFFD(self, f)
+            fd = XTAFFD(self, f, readahead)
+            if buffering > 0:
+                return io.BufferedReader(fd, buffering)
+            return fd
         else:
             return None
 
@@ -231,41 +977,24 @@ class Partition(object):
             While not end of file records
             Create a file record object
             Return list of file records
-            Date format: 
+            Each 64 byte entry is decoded with a single precompiled unpack_from on the cluster buffer
         """
         file_records = []
-        pos = 0
-        while pos + 64 < len(data): # FileRecord struct offsets
-            fnlen = data[pos]
-            flags = data[pos+1]
-            if ord(fnlen) == 0xE5: # Handle deleted files
-                name = '~' + data[pos+2:pos+2+42].strip("\xff\x00")
-            elif ord(fnlen) > 42: # Technically >42 should be an error condition
+        unpack_from = FILE_RECORD_STRUCT.unpack_from
+        for pos in xrange(0, len(data) - 64, 64): # FileRecord struct offsets
+            (fnlen, flags, name, cl, size, creation_date, creation_time, access_date, access_time,\
+                update_date, update_time) = unpack_from(data, pos)
+            length = ord(fnlen)
+            if length == 0xE5: # Handle deleted files
+                name = '~' + name.strip("\xff\x00")
+            elif length > 42: # Technically >42 should be an error condition
                 break
-            elif ord(fnlen) == 0: # A vacant entry, maybe the end of the directory?
-                pos += 64
+            elif length == 0: # A vacant entry, maybe the end of the directory?
                 continue
             else: 
-                name = data[pos+2:pos+2+42].strip("\xff\x00") # Ignoring fnlen is a bit wasteful
-            cl = struct.unpack(">I", data[pos+0x2c:pos+0x2c+4])[0]
-            size = struct.unpack(">I", data[pos+0x30:pos+0x30+4])[0]
-            creation_date = struct.unpack(">H", data[pos+0x34:pos+0x34+2])[0]
-            creation_time = struct.unpack(">H", data[pos+0x36:pos+0x36+2])[0]
-            access_date = struct.unpack(">H", data[pos+0x38:pos+0x38+2])[0]
-            access_time = struct.unpack(">H", data[pos+0x3A:pos+0x3A+2])[0]
-            update_date = struct.unpack(">H", data[pos+0x3C:pos+0x3C+2])[0]
-            update_time = struct.unpack(">H", data[pos+0x3E:pos+0x3E+2])[0]
-
-            #if not (fnlen == '\xff' and flags == '\xff') and not fnlen == '\x00':
-            if (ord(fnlen) < 43 and ord(fnlen) != 0) or (ord(fnlen) == 0xE5):
-                file_records.append(FileRecord(fnsize=fnlen, attribute=flags, filename=name, cluster=cl,\
-                                               fsize=size, mtime=update_time, mdate=update_date,\
-                                               adate=access_date, atime=access_time,\
-                                               cdate=creation_date, ctime=creation_time))
-            else:
-                pass
-
-            pos += 64
+                name = name.strip("\xff\x00") # Ignoring fnlen is a bit wasteful
+            file_records.append(FileRecord(fnlen, flags, name, cl, size, update_time, update_date,\
+                                           creation_time, creation_date, access_time, access_date))
 
         return file_records
 
@@ -277,31 +1006,91 @@ class Partition(object):
             Using this will eliminate much of the advantage of precache = False.
             The only remaining speedup will be the lazy caching of file cluster lists
         """
+        if self.filetable != None:
+            for filename in self.walk_file_table(path):
+                yield filename
+            return
+
         f = self.get_file(path)
         if f == None or not f.isDirectory():
             return
-        files = [f]
+        files = deque([f])
 
         while len(files) > 0:
-            f = files.pop(0)
+            f = files.popleft()
             if f.isDirectory():
-                if not f.root and len(f.clusters) == 0:
+                if not f.root and len(f.extents) == 0:
                     f = self.parse_directory(f) 
-                files = files + f.files.values()
+                files.extend(f.files.values())
             yield f.fullpath
 
-        return 
+    def walk_tree(self, path = '/', threads = 0, readahead = 8):
+        """ An os.walk style generator yielding (dirpath, dirnames, filenames) for every directory below path.
+            Directories are visited breadth first and, like os.walk, removing names from dirnames prunes them.
+            With threads > 0 the clusters of the next readahead queued directories are read by a thread pool
+            while the current one is being processed. That needs a threadsafe or memory mapped partition.
+        """
+        if self.filetable != None:
+            for entry in self.walk_file_table_tree(path):
+                yield entry
+            return
+
+        top = self.get_file(path)
+        if top == None or not top.isDirectory():
+            return
+
+        pool = None
+        if threads > 0 and (self.threadsafe or self.mmap != None):
+            pool = ThreadPool(threads)
+        pending = {}
+        dirs_to_process = deque([top])
+        try:
+            while len(dirs_to_process) > 0:
+                d = dirs_to_process.popleft()
+                if pool != None: # Start reading the directories that are coming up
+                    for upcoming in islice(dirs_to_process, readahead):
+                        if len(upcoming.extents) == 0 and upcoming.fullpath not in pending:
+                            pending[upcoming.fullpath] = pool.apply_async(self.read_directory, (upcoming,))
 
-            
+                if not d.root and len(d.extents) == 0:
+                    if d.fullpath in pending:
+                        extents, directory_data = pending.pop(d.fullpath).get()
+                    else:
+                        extents, directory_data = self.read_directory(d)
+                    if self.threadsafe:
+                        self.lock.acquire()
+                    try:
+                        if len(d.extents) == 0: # Unless another thread parsed it first
+                            self.add_file_records(d, extents, directory_data)
+                    finally:
+                        if self.threadsafe:
+                            self.lock.release()
 
+                dirnames = []
+                filenames = []
+                for name, f in d.files.iteritems():
+                    if f.isDirectory():
+                        dirnames.append(name)
+                    else:
+                        filenames.append(name)
+                yield d.fullpath, dirnames, filenames
+                dirs_to_process.extend([d.files[name] for name in dirnames if name in d.files])
+        finally:
+            if pool != None:
+                pool.terminate()
 
     def get_file(self, filename):
         """ Returns a fileobj from a filename. 
             Checks allfiles and if it isn't present starts walking the allfiles directory.
             Not the same as self.allfiles[filename] anymore. """
+        if self.filetable != None:
+            row = self.filetable.find(filename)
+            if row == -1:
+                return None
+            return self.table_fileobj(row, filename)
         if filename in self.allfiles: 
             currentfile = self.allfiles[filename]
-            if currentfile.isDirectory() and not currentfile.root and len(currentfile.clusters) == 0:
+            if currentfile.isDirectory() and not currentfile.root and len(currentfile.extents) == 0:
                 # If we're asked for a directory, initialise it before returning
                 currentfile = self.parse_directory(currentfile) 
             return currentfile # A previously accessed file
@@ -318,7 +1107,7 @@ class Partition(object):
             if currentfile == None:
                 break
             # If this is a directory (that isn't root) and it has no clusters listed, try to initialise it
-            if currentfile.isDirectory() and not currentfile.root and len(currentfile.clusters) == 0:
+            if currentfile.isDirectory() and not currentfile.root and len(currentfile.extents) == 0:
                 currentfile = self.parse_directory(currentfile)
             try:
                 currentfile = currentfile.files[component]
@@ -332,9 +1121,198 @@ class Partition(object):
         return currentfile
 
 
+    def build_file_table(self):
+        """ Parses every directory on the partition (breadth first) into a FileTable """
+        table = FileTable(self.root_dir_cluster)
+        dirs_to_process = deque([0])
+        while len(dirs_to_process) > 0:
+            row = dirs_to_process.popleft()
+            if row == 0:
+                directory_data = self.read_cluster(self.root_dir_cluster)
+            else:
+                directory_data = self.read_extents(self.get_extents(table.get_record(row)), 2**32, cached = True)
+            for child in table.add_children(row, self.parse_file_records(directory_data)):
+                if table.isDirectory(child):
+                    dirs_to_process.append(child)
+        return table
+
+    def table_fileobj(self, row, fullpath):
+        """ Builds a fileobj for a FileTable row, directories get a files dict of their children """
+        table = self.filetable
+        if row == 0:
+            f = Directory(None, [(self.root_dir_cluster, 1)])
+            f.root = True
+        else:
+            fr = table.get_record(row)
+            if not fr.isDirectory():
+                f = FileObj(fr, [])
+                f.fullpath = fullpath
+                return f
+            f = Directory(fr, self.cached_extents(fr))
+        f.fullpath = fullpath
+        for child in table.children(row):
+            fr = table.get_record(child)
+            if fr.isDirectory():
+                c = Directory(fr, [])
+            else:
+                c = FileObj(fr, [])
+            if row == 0:
+                c.fullpath = '/' + fr.filename
+            else:
+                c.fullpath = fullpath + '/' + fr.filename
+            f.files[fr.filename] = c
+        return f
+
+    def walk_file_table(self, path = '/'):
+        """ The FileTable version of walk, yields every path below path """
+        table = self.filetable
+        row = table.find(path)
+        if row == -1 or not table.isDirectory(row):
+            return
+        rows = deque([(row, path)])
+        while len(rows) > 0:
+            row, fullpath = rows.popleft()
+            if table.isDirectory(row):
+                if row == 0:
+                    prefix = '/'
+                else:
+                    prefix = fullpath + '/'
+                for child in table.children(row):
+                    rows.append((child, prefix + table.name(child)))
+            yield fullpath
+
+    def walk_file_table_tree(self, path = '/'):
+        """ The FileTable version of walk_tree, no I/O is needed as the table is already built """
+        table = self.filetable
+        row = table.find(path)
+        if row == -1 or not table.isDirectory(row):
+            return
+        rows = deque([(row, path)])
+        while len(rows) > 0:
+            row, dirpath = rows.popleft()
+            dirnames = []
+            filenames = []
+            dirrows = {}
+            for child in table.children(row):
+                name = table.name(child)
+                if table.isDirectory(child):
+                    dirnames.append(name)
+                    dirrows[name] = child
+                else:
+                    filenames.append(name)
+            yield dirpath, dirnames, filenames
+            if row == 0:
+                prefix = '/'
+            else:
+                prefix = dirpath + '/'
+            rows.extend([(dirrows[name], prefix + name) for name in dirnames if name in dirrows])
+
+    def index_filename(self, index_dir = None):
+        """ The index lives next to the image unless a cache directory is given """
+        if index_dir == None:
+            return self.filename + INDEX_SUFFIX
+        name = "%s-%s%s" % (os.path.basename(self.filename),\
+                            hashlib.sha1(os.path.abspath(self.filename)).hexdigest()[:16], INDEX_SUFFIX)
+        return os.path.join(index_dir, name)
+
+    def index_key(self):
+        """ Identifies this image: its size, modification time and a hash of the FAT """
+        if self.segments != None:
+            size, mtime = self.fd.size, self.fd.mtime
+        else:
+            st = os.fstat(self.fd.fileno())
+            size, mtime = st.st_size, st.st_mtime
+        return (INDEX_VERSION, size, float(mtime), hashlib.sha1(self.fat_data).digest())
+
+    def save_index(self, indexfile):
+        """ Writes every parsed directory, file record and cluster extent list to indexfile
+            The index is plain packed data: a header holding the index_key followed by the records
+            parents first, each one (parent record, FileRecord fields, extent count) then the name and extents.
+        """
+        records = []
+        queue = [(self.rootfile, -1)]
+        while len(queue) > 0:
+            d, parent = queue.pop()
+            for f in d.files.values():
+                if not f.isDirectory() and len(f.extents) == 0:
+                    f.extents = self.get_extents(f.fr)
+                fr = f.fr
+                records.append(INDEX_RECORD_STRUCT.pack(parent, fr.fnsize, fr.attribute, len(fr.filename),
+                                                        fr.cluster, fr.fsize, fr.mtime, fr.mdate, fr.ctime, fr.cdate,
+                                                        fr.atime, fr.adate, len(f.extents)))
+                records.append(fr.filename)
+                records.append(struct.pack(">%dI" % (len(f.extents) * 2), *[n for extent in f.extents for n in extent]))
+                if f.isDirectory():
+                    queue.append((f, len(records) / 3 - 1))
+        try:
+            with open(indexfile + '.tmp', 'wb') as fd:
+                fd.write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, *(self.index_key() + (len(records) / 3,))))
+                fd.write("".join(records))
+            os.rename(indexfile + '.tmp', indexfile)
+        except (IOError, OSError) as e:
+            print "Unable to write index %s: %s" % (indexfile, e)
+
+    def load_index(self, indexfile):
+        """ Rebuilds the directory tree from indexfile
+            Returns None if it is missing, doesn't match the image or can't be read for any reason
+            (truncated, tampered with or written by another version), in which case the image is parsed.
+        """
+        try:
+            with open(indexfile, 'rb') as fd:
+                data = fd.read()
+            return self.parse_index(data)
+        except Exception:
+            return None
+
+    def parse_index(self, data):
+        """ Decodes the contents of an index file, any malformed input raises an exception """
+        header = INDEX_HEADER_STRUCT.unpack_from(data, 0)
+        if header[0] != INDEX_MAGIC or header[1:5] != self.index_key():
+            return None
+        count = header[5]
+        pos = INDEX_HEADER_STRUCT.size
+        if pos + count * INDEX_RECORD_STRUCT.size > len(data):
+            raise ValueError("Truncated index")
+
+        root = Directory(None, [(self.root_dir_cluster, 1)])
+        root.root = True
+        root.fullpath = '/'
+        allfiles = {'/': root}
+        objs = []
+        for i in xrange(count):
+            fields = INDEX_RECORD_STRUCT.unpack_from(data, pos)
+            pos += INDEX_RECORD_STRUCT.size
+            parent, namelen, nextents = fields[0], fields[3], fields[12]
+            name = data[pos:pos + namelen]
+            pos += namelen
+            if len(name) != namelen or pos + nextents * 8 > len(data):
+                raise ValueError("Truncated index")
+            runs = struct.unpack_from(">%dI" % (nextents * 2), data, pos)
+            pos += nextents * 8
+            extents = zip(runs[0::2], runs[1::2])
+            fr = FileRecord(fields[1], fields[2], name, *fields[4:12])
+            if fr.isDirectory():
+                f = Directory(fr, extents)
+            else:
+                f = FileObj(fr, extents)
+            if parent == -1:
+                d = root
+            elif 0 <= parent < len(objs) and objs[parent].isDirectory():
+                d = objs[parent]
+            else:
+                raise ValueError("Bad parent in index")
+            f.fullpath = d.fullpath.rstrip('/') + '/' + name
+            d.files[name] = f
+            allfiles[f.fullpath] = f
+            objs.append(f)
+        if pos != len(data):
+            raise ValueError("Trailing data in index")
+        self.allfiles = allfiles
+        return root
+
     def init_root_directory(self, recurse = False):
         """ Creates the root directory object and calls parse_directory on it """
-        directory = Directory(None, [self.root_dir_cluster])
+        directory = Directory(None, [(self.root_dir_cluster, 1)])
         directory.root = True
         directory.fullpath = '/'
         self.allfiles[directory.fullpath] = directory
@@ -345,33 +1323,68 @@ class Partition(object):
     def parse_directory(self, directory = None, recurse = False):
         """ Parses a single directory, optionally it can recurse into subdirectories.
             It populates the allfile dict and parses the directories and file records of the directory """
-        dirs_to_process = []
         if directory == None:
             return None
+        dirs_to_process = deque([directory])
+
+        # Directory parsing is serialised when threadsafe so a directory is never seen half parsed
+        if self.threadsafe:
+            self.lock.acquire()
+
+        try:
+            # For each directory to process (will be only one unless recurse is True)
+            while len(dirs_to_process) > 0:
+                d = dirs_to_process.popleft()
+                if not d.root and len(d.extents) > 0:
+                    continue # Another thread parsed it while this one waited for the lock
+                extents, directory_data = self.read_directory(d)
+                subdirs = self.add_file_records(d, extents, directory_data)
+                if recurse:
+                    dirs_to_process.extend(subdirs)
+        finally:
+            if self.threadsafe:
+                self.lock.release()
+        return directory
+
+    def read_directory(self, d):
+        """ Reads the raw clusters of a directory, returns its extents and data """
+        extents = d.extents
+        if d.root:
+            directory_data = self.read_cluster(self.root_dir_cluster)
         else:
-            dirs_to_process.append(directory)
+            if len(extents) == 0:
+                extents = self.get_extents(d.fr)
+            directory_data = self.read_extents(extents, 2**32, cached = True)
+        return extents, directory_data
 
-        # For each directory to process (will be only one unless recurse is True)
-        while len(dirs_to_process) > 0:
-            d = dirs_to_process.pop(0)
+    def add_file_records(self, d, extents, directory_data):
+        """ Parses the file records in directory_data into d and allfiles, returns the subdirectories found """
+        subdirs = []
+        for fr in self.parse_file_records(directory_data):
+            if fr.isDirectory():
+                f = Directory(fr, [])
+                subdirs.append(f)
+            else:
+                f = FileObj(fr, [])
             if d.root:
-                directory_data = self.read_cluster(self.root_dir_cluster)
+                f.fullpath = d.fullpath + fr.filename
             else:
-                directory_data = self.read_file(fileobj = d)
-
-            # Parse the file records returned and optionally requeue subdirectories
-            file_records = self.parse_file_records(directory_data)
-            for fr in file_records:
-                if fr.isDirectory():
-                    d.files[fr.filename] = Directory(fr, [])
-                    if recurse:
-                        dirs_to_process.append(d.files[fr.filename])
-                else:
-                    d.files[fr.filename] = FileObj(fr, [])
-                if d.root:
-                    d.files[fr.filename].fullpath = d.fullpath + fr.filename
-                else:
-                    d.files[fr.filename].fullpath = d.fullpath + '/' + fr.filename
-                self.allfiles[d.files[fr.filename].fullpath] = d.files[fr.filename]
-        return directory
+                f.fullpath = d.fullpath + '/' + fr.filename
+            d.files[fr.filename] = f
+            self.allfiles[f.fullpath] = f
+        d.extents = extents # Set last, an empty extent list is what marks a directory as unparsed
+        return subdirs
+
+def extract_all(argv):
+    if len(argv) < 3:
+        print "Usage: partition.py <xtaf image> <output directory> [threads]"
+        print "Dumps contents of an XTAF partition to disk"
+        return
+    threads = 4
+    if len(argv) > 3:
+        threads = int(argv[3])
+    part = Partition(argv[1], threadsafe = True)
+    part.extract(argv[2], threads = threads)
 
+if __name__ == '__main__':
+    extract_all(sys.argv)
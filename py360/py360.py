@@ -1,6 +1,7 @@
 # py360.py is the FUSE interface for XTAF Filesystems.
 # To mount a filesystem run this file or the mount.py360 shell script
 # To programmatically interact with XTAF Filesystems check the partition module.
+# Mounting with -o containers also shows every STFS container as a <name>.stfs directory.
 #
 # FIXME: When running stfs.py against a mounted xtaf fs some blocks appear to be emtpy.
 #        This can be worked around by reading other blocks first (which is a bit weird)
@@ -8,11 +9,17 @@
 
 
 from fuse import Fuse
-from partition import Partition
+from partition import Partition, DEFAULT_CACHE_CLUSTERS, DEFAULT_READAHEAD
+from stfs import STFS, STFS_MAGIC, HEADER_SIZE
+from collections import OrderedDict
+from threading import Lock
 import time, fuse
 import xboxtime
 import sys, stat, errno
 
+STFS_SUFFIX = '.stfs'
+DEFAULT_CONTAINER_CACHE = 32
+
 fuse.fuse_python_api = (0, 2)
 
 if not hasattr(fuse, '__version__'):
@@ -33,15 +40,124 @@ class MyStat(fuse.Stat):
         self.st_mtime = 0
         self.st_ctime = 0
 
+# An opened STFS container with what is needed to serve it as a directory
+class Container(object):
+    def __init__(self, stfs):
+        self.stfs = stfs
+        self.lock = Lock() # The STFS object reads through one XTAFFD
+        self.fds = {} # STFSFD per path, so the block index of a file is only built once
+        self.children = {'/': []}
+        for path in sorted(stfs.allfiles):
+            parent, name = path.rsplit('/', 1)
+            self.children.setdefault(parent or '/', []).append(name)
+            if stfs.allfiles[path].isdirectory:
+                self.children.setdefault(path, [])
+
+    def read(self, path, size, offset):
+        fl = self.stfs.allfiles.get(path)
+        if path.rstrip('/') == '' or (fl != None and fl.isdirectory):
+            return -errno.EISDIR
+        if fl == None:
+            return -errno.ENOENT
+        with self.lock:
+            fd = self.fds.get(path)
+            if fd == None:
+                fd = self.stfs.open_fd(path, buffering = 0)
+                if fd == None:
+                    return -errno.ENOENT
+                self.fds[path] = fd
+            fd.seek(offset)
+            return fd.read(size)
+
 # Main FUSE class
 class Py360(Fuse):
     def __init__(self, *args, **kw):
         filename = kw.pop('filename')
         Fuse.__init__(self, *args, **kw)
-        self.partition = Partition(filename, threadsafe = False)
-
+        self.partition = Partition(filename, threadsafe = True, cache_size = DEFAULT_CACHE_CLUSTERS)
+        self.containers = False # Set by the containers mount option
+        self.container_cache = OrderedDict() # Least recently used opened containers
+        self.container_magic = {} # Whether a file is an STFS container
+        self.lock = Lock()
+
+    def is_container(self, path, fileobj = None):
+        """ Checks (once) whether a file on the partition starts with an STFS magic
+            Directories and files too small to hold an STFS header are never read. Pass the fileobj
+            (such as an entry of its Directory's files) to avoid looking the path up.
+        """
+        if path not in self.container_magic:
+            if fileobj == None:
+                fileobj = self.partition.get_file(path)
+            self.container_magic[path] = fileobj != None and not fileobj.isDirectory() and\
+                                         fileobj.fr.fsize >= HEADER_SIZE and\
+                                         self.partition.read_file(fileobj = fileobj, size = 4) in STFS_MAGIC
+        return self.container_magic[path]
+
+    def split_container_path(self, path):
+        """ Splits a path that goes into a <name>.stfs directory into the container's path and the path inside it """
+        if not self.containers or STFS_SUFFIX not in path:
+            return None
+        components = path.split('/')
+        for i in xrange(1, len(components)):
+            if components[i].endswith(STFS_SUFFIX):
+                container = '/'.join(components[:i] + [components[i][:-len(STFS_SUFFIX)]])
+                if self.is_container(container):
+                    return container, '/' + '/'.join(components[i + 1:])
+        return None
+
+    def open_container(self, path):
+        """ Returns a cached Container for an STFS file on the partition (or None if it can't be parsed) """
+        with self.lock:
+            if path in self.container_cache:
+                container = self.container_cache.pop(path)
+                self.container_cache[path] = container
+                return container
+        try:
+            container = Container(STFS(path, fd = self.partition.open_fd(path, readahead = DEFAULT_READAHEAD)))
+        except (IOError, AssertionError):
+            return None
+        with self.lock:
+            self.container_cache[path] = container
+            while len(self.container_cache) > DEFAULT_CONTAINER_CACHE:
+                self.container_cache.popitem(last = False)
+        return container
+
+    def container_getattr(self, container_path, inner):
+        st = MyStat()
+        if inner.rstrip('/') == '':
+            # The <name>.stfs directory itself is described by the XTAF file, so ls -l of a directory
+            # full of containers doesn't parse any of them
+            fileobj = self.partition.get_file(container_path)
+            st.st_mode = stat.S_IFDIR | 0555
+            st.st_nlink = 2
+            st.st_atime = xboxtime.cached_fat2unixtime(fileobj.fr.atime, fileobj.fr.adate)
+            st.st_mtime = xboxtime.cached_fat2unixtime(fileobj.fr.mtime, fileobj.fr.mdate)
+            st.st_ctime = xboxtime.cached_fat2unixtime(fileobj.fr.ctime, fileobj.fr.cdate)
+        else:
+            container = self.open_container(container_path)
+            if container == None:
+                return -errno.ENOENT
+            fl = container.stfs.allfiles.get(inner.rstrip('/'))
+            if fl == None:
+                return -errno.ENOENT
+            if fl.isdirectory:
+                st.st_mode = stat.S_IFDIR | 0555
+                st.st_nlink = len(container.children.get(inner.rstrip('/'), []))
+            else:
+                st.st_mode = stat.S_IFREG | 0444
+                st.st_size = fl.size
+            st.st_atime = xboxtime.cached_fat2unixtime(fl.atime, fl.adate)
+            st.st_mtime = xboxtime.cached_fat2unixtime(fl.utime, fl.udate)
+            st.st_ctime = st.st_mtime
+        context = self.GetContext()
+        st.st_uid = context['uid']
+        st.st_gid = context['gid']
+        return st
 
     def getattr(self, path):
+        split = self.split_container_path(path)
+        if split != None:
+            return self.container_getattr(*split)
         st = MyStat()
         fileobj = self.partition.get_file(path)
         if fileobj:
@@ -53,9 +169,9 @@ class Py360(Fuse):
             if not fileobj.isDirectory() or not fileobj.root:
                 st.st_size = fileobj.fr.fsize
                 st.st_ino = fileobj.fr.cluster
-                st.st_atime = xboxtime.fat2unixtime(fileobj.fr.atime, fileobj.fr.adate)
-                st.st_mtime = xboxtime.fat2unixtime(fileobj.fr.mtime, fileobj.fr.mdate)
-                st.st_ctime = xboxtime.fat2unixtime(fileobj.fr.ctime, fileobj.fr.cdate)
+                st.st_atime = xboxtime.cached_fat2unixtime(fileobj.fr.atime, fileobj.fr.adate)
+                st.st_mtime = xboxtime.cached_fat2unixtime(fileobj.fr.mtime, fileobj.fr.mdate)
+                st.st_ctime = xboxtime.cached_fat2unixtime(fileobj.fr.ctime, fileobj.fr.cdate)
             context = self.GetContext()
             st.st_uid = context['uid']
             st.st_gid = context['gid']
@@ -65,16 +181,32 @@ class Py360(Fuse):
             return -errno.ENOENT
 
     def readdir(self, path, offset): #Why does this have an offset?
+        split = self.split_container_path(path)
+        if split != None:
+            container = self.open_container(split[0])
+            inner = split[1].rstrip('/') or '/'
+            if container == None or inner not in container.children:
+                return -errno.ENOENT
+            return [fuse.Direntry(f) for f in ['.', '..'] + container.children[inner]]
         fileobj = self.partition.get_file(path)
         if fileobj and fileobj.isDirectory():
             dirlist = [fuse.Direntry('.'), fuse.Direntry('..')]
-            for f in fileobj.files:
+            prefix = path.rstrip('/') + '/'
+            for f, child in fileobj.files.iteritems():
                 dirlist.append(fuse.Direntry(f)) 
+                if self.containers and not child.isDirectory() and self.is_container(prefix + f, child):
+                    dirlist.append(fuse.Direntry(f + STFS_SUFFIX))
             return dirlist
         else:
             return -errno.ENOENT
 
     def read(self, path, size, offset):
+        split = self.split_container_path(path)
+        if split != None:
+            container = self.open_container(split[0])
+            if container == None:
+                return -errno.ENOENT
+            return container.read(split[1], size, offset)
         fileobj = self.partition.get_file(path)
         if fileobj:
             return self.partition.read_file(fileobj = fileobj, size = size, offset = offset)
@@ -91,15 +223,14 @@ Python FUSE file system for Xbox 360 hard drives (XFAT)
                      usage=usage,
                      dash_s_do='setsingle')
 
-    # While Partition is (now) thread safe, testing showed that single threaded
-    # mode was 6 times faster. This is because only one cluster could be read
-    # at a time regardless of number of threads. With a file object pool or a
-    # file cache this might swing the other way.
-    # If implementing this remember Fuse loves to read in 128kb chunks.
-    # 
-    # Partition is only optionally threadsafe
-    server.multithreaded = False 
-    server.parse(errex=1)
+    # Partition reads go through a pool of file objects when it is threadsafe
+    # so readers no longer queue behind one file pointer and
+    # several FUSE threads can be served in parallel. Only directory parsing is
+    # serialised. Remember Fuse loves to read in 128kb chunks.
+    server.multithreaded = True
+    server.parser.add_option(mountopt="containers", action="store_true", default=False,
+                             help="show each STFS container as a browsable <name>.stfs directory")
+    server.parse(values=server, errex=1)
     server.main()
 
 if __name__ == '__main__':
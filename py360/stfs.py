@@ -2,12 +2,30 @@
 Secure Transacted File System - A container format found on Xbox 360 XTAF partitions
 See http://free60.org/STFS
 """
+import io
 import struct
 from constants import ContentTypes, STFSHashInfo
 import hashlib
+from array import array
+from itertools import chain
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
-# TODO: Handle verifying non-data blocks
+STFS_MAGIC = ("CON ", "PIRS", "LIVE")
+HEADER_SIZE = 0x971A
+HEADER_FIELDS_SIZE = 0x171A # Everything before the thumbnail, enough for a lazy open
+LAZY_HEADER = ("data", "thumbnail", "titleimage", "additional_display_names", "additional_display_descriptions")
+LAZY_FILETABLE = ("filelistings", "allfiles")
+FILE_LISTING_STRUCT = struct.Struct(">40sB9xhIHHHH") # The 24 bit block numbers are little endian, see BLOCK24_STRUCT
+BLOCK24_STRUCT = struct.Struct("<I") # Masked to 24 bits
+HASH_ENTRY_STRUCT = struct.Struct(">I") # Info byte and 24 bit next block after the SHA1 of a hash record
+DEFAULT_VERIFY_THREADS = 4
+
+def check_hashes(task):
+    """ Given (data, hashes) compare each 0x1000 byte block of data with its SHA1, None skips a block """
+    data, hashes = task
+    return [expected == None or hashlib.sha1(buffer(data, i << 12, 0x1000)).digest() == expected\
+            for i, expected in enumerate(hashes)]
 
 class BlockHashRecord(object):
     """ Object containing the SHA1 hash of a block as well as its free/used information and next block """
@@ -34,127 +52,337 @@ class FileListing(object):
     """ Object containing the information about a file in the STFS container
         Data includes size, name, path and firstblock and atime and utime
     """
+    __slots__ = ("filename", "isdirectory", "numblocks", "firstblock", "pathindex", "size", "udate", "utime", "adate", "atime")
+
     def __str__(self):
         return "STFS File Listing: %s" % self.filename
 
-    def __init__(self, data):
-        self.filename = data[:0x28].strip('\x00')
+    def __init__(self, data, offset=0):
+        """ Decodes the 0x40 byte listing at offset in data with precompiled structs """
+        filename, flags, self.pathindex, self.size, self.udate, self.utime, self.adate, self.atime =\
+            FILE_LISTING_STRUCT.unpack_from(data, offset) # Signedness of pathindex is important
+        self.filename = filename.strip('\x00')
         assert self.filename != '', "FileListing has empty filename"
-        self.isdirectory = 0x80 & ord(data[0x28]) == 0x80
-        self.numblocks = struct.unpack("<I", "%s\x00" % data[0x29:0x29+3])[0] # More little endian madness!
-        self.firstblock = struct.unpack("<I", "%s\x00" % data[0x2F:0x2F+3])[0]# And again!
-        self.pathindex = struct.unpack(">h", data[0x32:0x34])[0] # Signedness is important here
-        self.size = struct.unpack(">I", data[0x34:0x38])[0]
-        self.udate = struct.unpack(">H", data[0x38:0x3A])[0]
-        self.utime = struct.unpack(">H", data[0x3A:0x3C])[0]
-        self.adate = struct.unpack(">H", data[0x3C:0x3E])[0]
-        self.atime = struct.unpack(">H", data[0x3E:0x40])[0]
+        self.isdirectory = 0x80 & flags == 0x80
+        self.numblocks = BLOCK24_STRUCT.unpack_from(data, offset + 0x29)[0] & 0xFFFFFF # More little endian madness!
+        self.firstblock = BLOCK24_STRUCT.unpack_from(data, offset + 0x2F)[0] & 0xFFFFFF # And again!
+
+class STFSFD(io.RawIOBase):
+    """ A File-like object for reading a file inside an STFS container
+        It is an io.RawIOBase with readinto so it can be wrapped in an io.BufferedReader.
+        The disk block of every block in the file is worked out once so seeks are O(1) and
+        reads only touch the blocks they need, consecutive disk blocks are read together.
+        It shares the container's file object so don't use it from several threads at once.
+    """
+    def __init__(self, stfs, filelisting):
+        super(STFSFD, self).__init__()
+        self.pointer = 0
+        self.stfs = stfs
+        self.filelisting = filelisting
+        self.size = filelisting.size
+        self.blocks = array('I') # Disk block of each block of the file
+        for blocknum, count in stfs.block_runs(filelisting.firstblock, (self.size + 0xFFF) >> 12):
+            self.blocks.extend(xrange(blocknum, blocknum + count))
+        self.size = min(self.size, len(self.blocks) << 12) # A broken chain shortens the file
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b)
+        length = min(len(view), self.size - self.pointer)
+        done = 0
+        while done < length:
+            index = (self.pointer + done) >> 12
+            within = (self.pointer + done) & 0xFFF
+            count = 1
+            while index + count < len(self.blocks) and self.blocks[index + count] == self.blocks[index] + count and\
+                  (count << 12) - within < length - done:
+                count += 1
+            readlen = min((count << 12) - within, length - done)
+            self.stfs.fd.seek(0xc000 + self.blocks[index] * 0x1000 + within)
+            data = self.stfs.fd.read(readlen)
+            view[done:done + len(data)] = data
+            done += len(data)
+            if len(data) < readlen:
+                break
+        self.pointer += done
+        return done
+
+    def read(self, length=-1):
+        if length < 0:
+            length = self.size - self.pointer
+        buf = bytearray(max(0, min(length, self.size - self.pointer)))
+        del buf[self.readinto(buf):]
+        return str(buf)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pointer = offset
+        if whence == 1:
+            self.pointer = self.pointer + offset
+        if whence == 2:
+            self.pointer = self.size + offset
+        self.pointer = max(0, min(self.pointer, self.size))
+        return self.pointer
+
+    def tell(self):
+        return self.pointer
 
 class STFS(object):
     """ Object representing the STFS container. allfiles dict contains a path to filelisting map """
     def __str__(self):
         return "STFS Object %s (%s)" % (self.magic, self.filename)
     
-    def __init__(self, filename, fd=None):
-        """ Takes either a filename to open or a file object (including StringIO) to parse """
+    def __init__(self, filename, fd=None, lazy=False):
+        """ Takes either a filename to open or a file object (including StringIO) to parse
+            With lazy only the header fields before the thumbnail are read, the images (and the rest
+            of the header) are read on first access and the file table is parsed when allfiles is used.
+        """
         self.filename = filename
         if not fd:
             self.fd = open(filename, 'rb')
         else:
             self.fd = fd
         data = self.fd.read(4)
-        assert data in ("CON ", "PIRS", "LIVE"), "STFS Magic not found"
+        assert data in STFS_MAGIC, "STFS Magic not found"
 
         self.table_spacing = [(0xAB, 0x718F, 0xFE7DA), #The distance in blocks between tables
                               (0xAC, 0x723A, 0xFD00B)] #For when tables are 1 block and when they are 2 blocks
         self.magic = data
+        self.table_cache = {} # Upper level hash tables used to find the active copy of lower tables
+        self.block_next = None # Lazily decoded from the level 0 tables by load_block_map
+        self.block_info = None
+        self.block_hashes = None
         self.fd.seek(0)
-        self.data = self.fd.read(0x971A) # Header data (this is only a member during testing)
-        self.parse_header(self.data)
-        self.parse_filetable()
+        if lazy:
+            self.parse_header_fields(self.fd.read(HEADER_FIELDS_SIZE))
+        else:
+            self.data = self.fd.read(HEADER_SIZE) # Header data (this is only a member during testing)
+            self.parse_header(self.data)
+            self.parse_filetable()
 
+    def __getattr__(self, name):
+        """ Loads the parts of a lazily opened container the first time they are used """
+        if name in LAZY_HEADER and "data" not in self.__dict__:
+            self.load_header()
+        elif name in LAZY_FILETABLE and "allfiles" not in self.__dict__:
+            self.parse_filetable()
+        else:
+            raise AttributeError(name)
+        return getattr(self, name)
+
+    def load_header(self):
+        """ Read the whole header and parse the images and additional locales (for lazily opened containers) """
+        self.fd.seek(0)
+        data = self.fd.read(HEADER_SIZE)
+        assert len(data) >= HEADER_SIZE, "STFS Data Too Short"
+        self.parse_header_images(data)
+        self.data = data
 
     def read_filetable(self, firstblock, numblocks):
         """ Given the length and start of the filetable return all its data
         """
-        buf = StringIO()
-        info = 0x80
-        block = firstblock
-        for i in xrange(0, numblocks):
-            buf.write(self.read_block(self.fix_blocknum(block), 0x1000))
-            blockhash = self.get_blockhash(block)
-            if self.table_size_shift > 0 and blockhash.info < 0x80:
-                blockhash = self.get_blockhash(block, 1)
-            block = blockhash.nextblock
-            info = blockhash.info
-        return buf.getvalue()
+        runs = self.block_runs(firstblock, numblocks, allocated_only=False)
+        return self.read_runs(runs, numblocks << 12)
     
     def parse_filetable(self):
-        """ Generate objects for all the filelistings """
-        data = StringIO()
-        self.filelistings = []
-        self.allfiles = {}
-        #for x in range(0, self.filetable_blockcount):
-        #    data.write(self.read_block(self.filetable_blocknumber + x))
-        #data = data.getvalue()
+        """ Generate objects for all the filelistings
+            Paths are built once per listing from the already resolved path of its parent
+        """
         data = self.read_filetable(self.filetable_blocknumber, self.filetable_blockcount)
-
-        for x in range(0, len(data), 0x40): # File records are 0x40 length
+        filelistings = []
+        for offset in xrange(0, len(data) - 0x3F, 0x40): # File records are 0x40 length
             try:
-                self.filelistings.append(FileListing(data[x:x+0x40]))
+                filelistings.append(FileListing(data, offset))
             except AssertionError:
                 pass
-        for fl in self.filelistings: # Build a dictionary to access filelistings by path
-            path_components = [fl.filename]
-            a = fl
-            while a.pathindex != -1 and a.pathindex < len(self.filelistings):
-                try:
-                    a = self.filelistings[a.pathindex]
-                    path_components.append(a.filename)
-                except IndexError:
-                    raise AssertionError("IndexError: %s %d %d" % (self.filename, a.pathindex, len(self.filelistings)))
-            path_components.append('')
-            path_components.reverse()
-            self.allfiles["/".join(path_components)] = fl
+
+        count = len(filelistings)
+        paths = [None] * count
+        for index in xrange(count): # Build a dictionary to access filelistings by path
+            pending = []
+            seen = set()
+            a = index
+            while paths[a] == None: # Climb until the root or a listing whose path is already known
+                pending.append(a)
+                seen.add(a)
+                parent = filelistings[a].pathindex
+                if parent == -1 or parent >= count:
+                    path = ''
+                    break
+                if parent < -count:
+                    raise AssertionError("IndexError: %s %d %d" % (self.filename, parent, count))
+                a = parent % count # Negative indexes count back from the end as they always have
+                if a in seen:
+                    raise AssertionError("Loop in file table: %s %d" % (self.filename, a))
+            else:
+                path = paths[a]
+            for a in reversed(pending):
+                path = path + '/' + filelistings[a].filename
+                paths[a] = path
+
+        self.filelistings = filelistings
+        self.allfiles = dict(zip(paths, filelistings))
                 
     def read_file(self, filelisting, size=-1):
         """ Given a filelisting object return its data
-            This requies checking each blockhash to find the next block.
-            In some cases this requires checking two different hash tables.
+            The chain of blocks is followed through the block map and blocks that are consecutive
+            on disk (everything between two hash tables) are read with one read.
         """
-        buf = StringIO()
         if size == -1:
             size = filelisting.size
-        block = filelisting.firstblock
+        runs = self.block_runs(filelisting.firstblock, (size + 0xFFF) >> 12)
+        return self.read_runs(runs, size)
+
+    def open_fd(self, path, buffering=io.DEFAULT_BUFFER_SIZE):
+        """ Return a seekable file object for a file in the container or None if there is no such file
+            It is an STFSFD wrapped in an io.BufferedReader unless buffering is 0
+        """
+        fl = self.allfiles.get(path)
+        if fl == None or fl.isdirectory:
+            return None
+        fd = STFSFD(self, fl)
+        if buffering > 0:
+            return io.BufferedReader(fd, buffering)
+        return fd
+
+    def block_chain(self, block, numblocks, allocated_only=True):
+        """ Follows a chain of up to numblocks blocks through the block map and returns their block numbers
+            With allocated_only the chain also stops at block 0 and at blocks that aren't in use.
+        """
+        self.load_block_map()
+        chain = []
         info = 0x80
-        while size > 0 and block > 0 and block < self.allocated_count and info >= 0x80:
-            readlen = min(0x1000, size)
-            buf.write(self.read_block(self.fix_blocknum(block), readlen))
-            size -= readlen
-            blockhash = self.get_blockhash(block) #TODO: Optional concurrent verification of blocks
-            #If there are multiple tables and the block is free or unused, try other table
-            #TODO: There may be times where both tables show allocated blocks yet only one was correct
-            #      It would be better to calculate the best chain of blocks, perhaps precalculate like Partition
-            if self.table_size_shift > 0 and blockhash.info < 0x80: 
-                blockhash = self.get_blockhash(block, 1)
-            block = blockhash.nextblock
-            info = blockhash.info
-        return buf.getvalue()
-    
-    def get_blockhash(self, blocknum, table_offset = 0):
-        """ Given a block number return the hash object that goes with it """
-        record = blocknum % 0xAA
-        #Num tables * space blocks between each (0xAB or 0xAC for [0])
-        tablenum = blocknum // 0xAA * self.table_spacing[self.table_size_shift][0]
-        if blocknum >= 0xAA:
-            tablenum += (blocknum // 0x70E4 + 1) << self.table_size_shift #skip level 1 tables 
-            if blocknum >= 0x70E4:
-                tablenum += 1 << self.table_size_shift #If we're into level 2 add the level 2 table
+        while numblocks > 0 and block < len(self.block_next):
+            if allocated_only and (block == 0 or info < 0x80):
+                break
+            chain.append(block)
+            numblocks -= 1
+            info = self.block_info[block]
+            block = self.block_next[block]
+        return chain
 
-        # Read the table block, get the correct record and pass it to BlockHashRecord
-        
+    def block_runs(self, block, numblocks, allocated_only=True):
+        """ Follows a chain of blocks like block_chain
+            Returns a list of [disk block, block count] runs of blocks that are consecutive on disk.
+        """
+        runs = []
+        last = 0
+        for block in self.block_chain(block, numblocks, allocated_only):
+            if len(runs) > 0 and block == last + 1 and block % 0xAA != 0: # Every 0xAA blocks there is a hash table in the way
+                runs[-1][1] += 1
+            else:
+                runs.append([self.fix_blocknum(block), 1])
+            last = block
+        return runs
+
+    def read_runs(self, runs, size):
+        """ Reads size bytes from a list of runs into one preallocated buffer """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        readinto = getattr(self.fd, 'readinto', None)
+        pos = 0
+        for blocknum, count in runs:
+            length = min(count << 12, size - pos)
+            if length <= 0:
+                break
+            self.fd.seek(0xc000 + blocknum * 0x1000)
+            if readinto != None:
+                n = readinto(view[pos:pos + length]) or 0
+            else:
+                data = self.fd.read(length)
+                n = len(data)
+                view[pos:pos + n] = data
+            pos += n
+            if n < length:
+                break
+        return str(buffer(buf, 0, pos))
+
+    def load_block_map(self):
+        """ Decodes the active copy of every level 0 hash table once into per block arrays
+            block_next and block_info hold the next block and the info byte of each allocated block
+            and block_hashes holds its SHA1. They replace a hash table read per block when following chains.
+        """
+        if self.block_next != None:
+            return
+        count = min(self.allocated_count, 0x4AF768)
+        block_next = array('I')
+        block_info = array('B')
+        block_hashes = []
+        for first in xrange(0, count, 0xAA):
+            data = self.read_block(self.active_table(first)).ljust(0x1000, '\x00')
+            for offset in xrange(0, min(0xAA, count - first) * 0x18, 0x18):
+                entry = HASH_ENTRY_STRUCT.unpack_from(data, offset + 0x14)[0]
+                block_hashes.append(data[offset:offset + 0x14])
+                block_info.append(entry >> 24)
+                block_next.append(entry & 0xFFFFFF)
+        self.block_hashes = block_hashes
+        self.block_info = block_info
+        self.block_next = block_next
+
+    def top_level(self):
+        """ The level of the top hash table, this depends on the number of allocated blocks """
+        if self.allocated_count <= 0xAA:
+            return 0
+        if self.allocated_count <= 0x70E4:
+            return 1
+        return 2
+
+    def table_block(self, blocknum, level=0):
+        """ Given a data block number return the first copy of the level 0, 1 or 2 hash table that covers it
+            Like get_blockhash the result is offset from data block numbers (so it is negative for the first tables)
+        """
+        shift = self.table_size_shift
+        if level == 0:
+            #Num tables * space blocks between each (0xAB or 0xAC for [0])
+            tablenum = blocknum // 0xAA * self.table_spacing[shift][0]
+            if blocknum >= 0xAA:
+                tablenum += (blocknum // 0x70E4 + 1) << shift #skip level 1 tables 
+                if blocknum >= 0x70E4:
+                    tablenum += 1 << shift #If we're into level 2 add the level 2 table
+        elif level == 1:
+            if blocknum < 0x70E4:
+                tablenum = self.table_spacing[shift][0]
+            else:
+                tablenum = (1 << shift) + blocknum // 0x70E4 * self.table_spacing[shift][1]
+        else:
+            tablenum = self.table_spacing[shift][1]
         # Fix to point at the first table (these numbers are offset from data block numbers)
-        tablenum += table_offset - (1 << self.table_size_shift) 
+        return tablenum - (1 << shift)
+
+    def active_table(self, blocknum, level=0):
+        """ Given a data block number return the active copy of its level 0, 1 or 2 hash table
+            When tables are 2 blocks long the top table's copy is chosen by bit 2 of block_seperation
+            and each lower table's copy by bit 0x40 of its record in the table above
+        """
+        tablenum = self.table_block(blocknum, level)
+        if self.table_size_shift == 0:
+            return tablenum
+        if level >= self.top_level():
+            return tablenum + ((self.block_seperation & 2) >> 1)
+        parent = self.active_table(blocknum, level + 1)
+        if parent not in self.table_cache:
+            self.table_cache[parent] = self.read_block(parent).ljust(0x1000, '\x00')
+        if level == 0:
+            record = blocknum // 0xAA % 0xAA
+        else:
+            record = blocknum // 0x70E4 % 0xAA
+        return tablenum + ((ord(self.table_cache[parent][record * 0x18 + 0x14]) & 0x40) >> 6)
+
+    def get_blockhash(self, blocknum, table_offset = None):
+        """ Given a block number return the hash object that goes with it
+            By default the record comes from the active table, table_offset 0 or 1 picks a copy
+        """
+        record = blocknum % 0xAA
+        if table_offset == None:
+            tablenum = self.active_table(blocknum)
+        else:
+            tablenum = self.table_block(blocknum) + table_offset
+        # Read the table block, get the correct record and pass it to BlockHashRecord
         hashdata = self.read_block(tablenum)
         return BlockHashRecord(blocknum, hashdata[record * 0x18: record * 0x18 + 0x18],\
                                table = tablenum, record = record)
@@ -167,6 +395,57 @@ class STFS(object):
         else:
             return False
 
+    def verify_tree(self, threads=DEFAULT_VERIFY_THREADS, batch=16):
+        """ Verify the whole hash tree of the container
+            The top hash table is checked against tophashtable_hash, every other hash table against its
+            record in the table above and every block in use against its level 0 record.
+            Blocks are read a hash table's worth at a time and batch groups are hashed by a pool of threads.
+            Returns a list of (kind, number, disk block, ok) tuples. kind is "level2", "level1", "level0"
+            (number is the table's index at that level) or "data" (number is the data block number).
+        """
+        self.load_block_map()
+        count = len(self.block_next)
+        top = self.top_level()
+        report = []
+        pool = ThreadPool(threads)
+        try:
+            parents = None
+            for level in xrange(top, -1, -1): # Top down so each table's parent has been read
+                span = 0xAA ** (level + 1)
+                tables = []
+                for i in xrange(max(1, (count + span - 1) // span)):
+                    tablenum = self.active_table(i * span, level)
+                    tables.append((tablenum, self.read_block(tablenum).ljust(0x1000, '\x00')))
+                if parents == None:
+                    expected = [self.tophashtable_hash]
+                else:
+                    expected = [parents[i // 0xAA][i % 0xAA * 0x18:i % 0xAA * 0x18 + 0x14] for i in xrange(len(tables))]
+                tasks = [("".join([data for tablenum, data in tables[i:i + 0xAA]]), expected[i:i + 0xAA])\
+                         for i in xrange(0, len(tables), 0xAA)]
+                results = chain(*pool.map(check_hashes, tasks))
+                for i, ((tablenum, data), ok) in enumerate(zip(tables, results)):
+                    report.append(("level%d" % level, i, tablenum, ok))
+                parents = [data for tablenum, data in tables]
+
+            groups = range(0, count, 0xAA)
+            for start in xrange(0, len(groups), batch):
+                tasks = []
+                for first in groups[start:start + batch]:
+                    numblocks = min(0xAA, count - first)
+                    self.fd.seek(0xc000 + self.fix_blocknum(first) * 0x1000)
+                    hashes = [self.block_hashes[b] if self.block_info[b] >= 0x80 else None\
+                              for b in xrange(first, first + numblocks)]
+                    tasks.append((first, self.fd.read(numblocks << 12), hashes))
+                results = pool.map(check_hashes, [(data, hashes) for first, data, hashes in tasks])
+                for (first, data, hashes), checked in zip(tasks, results):
+                    disk = self.fix_blocknum(first)
+                    for i, ok in enumerate(checked):
+                        if hashes[i] != None:
+                            report.append(("data", first + i, disk + i, ok))
+        finally:
+            pool.close()
+        return report
+
     def fix_blocknum(self, block_num):
         """
             Given a blocknumber calculate the block on disk that has the data taking into account hash blocks.
@@ -196,7 +475,13 @@ class STFS(object):
     # There is almost no logic here, just offsets.
     def parse_header(self, data):
         """ Parse the huge STFS header """
-        assert len(data) >= 0x971A, "STFS Data Too Short"
+        assert len(data) >= HEADER_SIZE, "STFS Data Too Short"
+        self.parse_header_fields(data)
+        self.parse_header_images(data)
+
+    def parse_header_fields(self, data):
+        """ Parse the header up to the thumbnail (everything but the images and additional locales) """
+        assert len(data) >= HEADER_FIELDS_SIZE, "STFS Data Too Short"
         self.magic = data[0:4]
         if self.magic == "CON ":
             self.console_id = data[6:11]
@@ -253,16 +538,12 @@ class STFS(object):
         self.transfer_flags = data[0x1711:0x1712]
         self.thumbnail_size = struct.unpack(">I", data[0x1712:0x1712+4])[0]
         self.titleimage_size = struct.unpack(">I", data[0x1716:0x1716+4])[0]
-        self.thumbnail = data[0x171A:0x171A+self.thumbnail_size]
-        self.titleimage = data[0x571A:0x571A+self.titleimage_size]
         
         if self.metadata_version == 2:
             self.series_id = data[0x3B1:0x3B1+0x10]
             self.season_id = data[0x3C1:0x3C1+0x10]
             self.season_number = struct.unpack(">H", data[0x3D1:0x3D1+2])[0]
             self.episode_number = struct.unpack(">H", data[0x3D3:0x3D3+2])[0]
-            self.additional_display_names = data[0x541A:0x541A+0x300]
-            self.additional_display_descriptions = data[0x941A:0x941A+0x300] 
         
         # Are the hash tables 1 or 2 blocks long?
         if ((self.entry_id + 0xFFF) & 0xF000) >> 0xC == 0xB:
@@ -270,6 +551,14 @@ class STFS(object):
         else:
             self.table_size_shift = 1
 
+    def parse_header_images(self, data):
+        """ Parse the thumbnail, title image and additional locales that follow the header fields """
+        self.thumbnail = data[0x171A:0x171A+self.thumbnail_size]
+        self.titleimage = data[0x571A:0x571A+self.titleimage_size]
+        if self.metadata_version == 2:
+            self.additional_display_names = data[0x541A:0x541A+0x300]
+            self.additional_display_descriptions = data[0x941A:0x941A+0x300] 
+
 
 def extract_all(argv):
     if len(argv) < 3:
@@ -0,0 +1,91 @@
+"""
+Block level differences between two STFS containers, such as the same profile from two acquisitions.
+Only the hash tables and file tables are read: blocks are compared by the SHA1 and status recorded
+for them in the level 0 hash tables and changed blocks are traced back to files through their chains.
+To use it try something like:
+    d = diff_containers(stfs.STFS('before/E00012DD5A4FAEE5'), stfs.STFS('after/E00012DD5A4FAEE5'))
+    print d
+    for path in d.changed_files:
+        print path
+"""
+
+import sys
+from stfs import STFS
+
+FILETABLE = "(file table)"
+
+def block_owners(container):
+    """ Maps every block in use to the path of the file (or the file table) whose chain it is in """
+    owners = {}
+    for block in container.block_chain(container.filetable_blocknumber, container.filetable_blockcount, False):
+        owners[block] = FILETABLE
+    for path, fl in container.allfiles.iteritems():
+        if not fl.isdirectory:
+            for block in container.block_chain(fl.firstblock, (fl.size + 0xFFF) >> 12):
+                owners[block] = path
+    return owners
+
+class ContainerDiff(object):
+    """ The differences between two STFS containers
+        changed_blocks are the block numbers whose hash or status differ (or that only one container has),
+        changed_files are the paths using any of those blocks in either container, added_files and
+        removed_files are paths that are only in the second or only in the first container.
+    """
+    def __str__(self):
+        return "STFS Diff %s / %s: %d changed blocks, %d changed files, %d added files, %d removed files" %\
+               (self.first.filename, self.second.filename, len(self.changed_blocks), len(self.changed_files),
+                len(self.added_files), len(self.removed_files))
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        self.changed_blocks = []
+        self.changed_files = []
+        self.added_files = []
+        self.removed_files = []
+        if first.tophashtable_hash == second.tophashtable_hash and first.allocated_count == second.allocated_count:
+            return # The top hash covers the whole tree
+
+        first.load_block_map()
+        second.load_block_map()
+        count = max(len(first.block_next), len(second.block_next))
+        for block in xrange(count):
+            if block >= len(first.block_next) or block >= len(second.block_next) or\
+               first.block_hashes[block] != second.block_hashes[block] or\
+               first.block_info[block] != second.block_info[block]:
+                self.changed_blocks.append(block)
+
+        self.added_files = sorted(set(second.allfiles) - set(first.allfiles))
+        self.removed_files = sorted(set(first.allfiles) - set(second.allfiles))
+        changed = set()
+        for container in (first, second):
+            owners = block_owners(container)
+            changed.update([owners[block] for block in self.changed_blocks if block in owners])
+        for path in set(first.allfiles) & set(second.allfiles): # A file can change without its blocks changing
+            a, b = first.allfiles[path], second.allfiles[path]
+            if (a.size, a.firstblock, a.isdirectory) != (b.size, b.firstblock, b.isdirectory):
+                changed.add(path)
+        self.changed_files = sorted(changed - set(self.added_files) - set(self.removed_files))
+
+def diff_containers(first, second):
+    """ Compare two STFS objects, returns a ContainerDiff """
+    return ContainerDiff(first, second)
+
+def main(argv):
+    if len(argv) < 3:
+        print "Usage: stfsdiff.py <first stfs file> <second stfs file>"
+        print "Lists the blocks and files that differ using the containers' hash tables"
+        return
+    d = diff_containers(STFS(argv[1]), STFS(argv[2]))
+    print d
+    for path in d.added_files:
+        print "Added: %s" % path
+    for path in d.removed_files:
+        print "Removed: %s" % path
+    for path in d.changed_files:
+        print "Changed: %s" % path
+    if len(d.changed_blocks) > 0:
+        print "Changed blocks: %s" % " ".join([str(block) for block in d.changed_blocks])
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,6 +1,24 @@
 """ Collection of functions to handle the various time formats that Xbox 360s have """
 
 import time
+import calendar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# FAT years are 7 bits from 1980, these tables turn a date into days since the unix epoch without libc
+FAT_EPOCH_YEAR = 1980
+YEAR_DAYS = [calendar.timegm((FAT_EPOCH_YEAR + y, 1, 1, 0, 0, 0, 0, 0, 0)) // 86400 for y in range(-1, 130)]
+MONTH_DAYS = ([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334],
+              [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335])
+MAX_CACHE = 0x10000
+
+date_cache = {}
+unixtime_cache = {}
+asctime_cache = {}
+ctime_cache = {}
 
 def parse_fat_date(date):
     """
@@ -33,6 +51,85 @@ def fat2unixtime(t, d):
     b = parse_fat_date(d)
     return time.mktime((1980 + b[2], b[1], b[0], a[0], a[1], a[2], 0, 0, 0))
 
+def fat_date_days(date):
+    """ Days from the unix epoch to a FAT date, out of range months and days roll over like mktime """
+    days = date_cache.get(date)
+    if days == None:
+        day, month, year = parse_fat_date(date)
+        year += (month - 1) // 12 # Month 0 is December of the previous year
+        month = (month - 1) % 12
+        leap = calendar.isleap(FAT_EPOCH_YEAR + year)
+        days = YEAR_DAYS[year + 1] + MONTH_DAYS[leap][month] + day - 1
+        date_cache[date] = days
+    return days
+
+def fat2utctime(t, d):
+    """ Turns date/time members from a FileRecord into unix time treating them as UTC
+        Table driven and memoized so there are no libc calls, format it with time.gmtime
+    """
+    return fat_date_days(d) * 86400 + 3600 * ((0xf800 & t) >> 11) + 60 * ((0x07e0 & t) >> 5) + 2 * (0x001f & t)
+
+def fat2utctimes(times, dates):
+    """ fat2utctime for whole sequences of FAT time and date words
+        Returns a numpy array if numpy is available otherwise a list
+    """
+    if numpy != None:
+        t = numpy.asarray(times, dtype = numpy.int64)
+        d = numpy.asarray(dates, dtype = numpy.int64)
+        day = d & 0x1f
+        month = (d & 0x1e0) >> 5
+        year = ((d & 0xfe00) >> 9) + (month - 1) // 12
+        month = (month - 1) % 12
+        leap = numpy.array([calendar.isleap(FAT_EPOCH_YEAR + y) for y in range(-1, 130)], dtype = numpy.int64)
+        days = numpy.asarray(YEAR_DAYS, dtype = numpy.int64)[year + 1] + \
+               numpy.asarray(MONTH_DAYS, dtype = numpy.int64)[leap[year + 1], month] + day - 1
+        return days * 86400 + 3600 * ((t & 0xf800) >> 11) + 60 * ((t & 0x07e0) >> 5) + 2 * (t & 0x1f)
+    return [fat2utctime(t, d) for t, d in zip(times, dates)]
+
+def cached_fat2unixtime(t, d):
+    """ fat2unixtime memoized on the time/date words, drives have few distinct timestamps """
+    key = (d << 16) | t
+    value = unixtime_cache.get(key)
+    if value == None:
+        if len(unixtime_cache) >= MAX_CACHE:
+            unixtime_cache.clear()
+        value = fat2unixtime(t, d)
+        unixtime_cache[key] = value
+    return value
+
+def fat2ctime(t, d):
+    """ time.ctime(fat2unixtime(t, d)) memoized on the time/date words, the format report360 prints """
+    key = (d << 16) | t
+    value = ctime_cache.get(key)
+    if value == None:
+        if len(ctime_cache) >= MAX_CACHE:
+            ctime_cache.clear()
+        value = time.ctime(fat2unixtime(t, d))
+        ctime_cache[key] = value
+    return value
+
+def fat2asctime(t, d):
+    """ Formats date/time members in the time.ctime format treating them as UTC (no libc timezone conversion)
+        This is the wall clock time stored on disk. It isn't always the same text as fat2ctime, which goes
+        through mktime with isdst=0 and so can be an hour out for dates in daylight saving time.
+    """
+    key = (d << 16) | t
+    value = asctime_cache.get(key)
+    if value == None:
+        if len(asctime_cache) >= MAX_CACHE:
+            asctime_cache.clear()
+        value = time.asctime(time.gmtime(fat2utctime(t, d)))
+        asctime_cache[key] = value
+    return value
+
 def filetime2unixtime(filetime):
     """ Convert GPD times to unix time (Windows File Times, 100ms since 1601) """
     return max(0, (filetime * 10**-7) - 11644505694L) # Convert 100s ms since 1601 to unix epoch
+
+def filetimes2unixtimes(filetimes):
+    """ filetime2unixtime for a whole sequence of FILETIME values
+        Returns a numpy array if numpy is available otherwise a list
+    """
+    if numpy != None:
+        return numpy.maximum(0, numpy.asarray(filetimes, dtype = numpy.int64) * 10**-7 - 11644505694L)
+    return [filetime2unixtime(filetime) for filetime in filetimes]
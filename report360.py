@@ -7,7 +7,6 @@ This version allows function reuse and swaps prints with a call to Report360.out
 
 import time, os, sys
 from py360 import xdbf, partition, account, stfs, xboxmagic, xboxtime
-from cStringIO import StringIO
 
 class Report360:
     """ A class to output information about py360 types """
@@ -51,13 +50,19 @@ class Report360:
         self.output("*********************")
         self.output("\nFILE LISTING")
         #for filename in part.allfiles:
-        for filename in part.walk():
-            fi = part.get_file(filename)
-            if fi.fr:
-                self.output("File: %s\t%d" % (filename, fi.fr.fsize))
-                self.output("%s\t%s\t%s\n" % (time.ctime(xboxtime.fat2unixtime(fi.fr.mtime, fi.fr.mdate)),\
-                                            time.ctime(xboxtime.fat2unixtime(fi.fr.atime, fi.fr.adate)),\
-                                            time.ctime(xboxtime.fat2unixtime(fi.fr.ctime, fi.fr.cdate))))
+        # Each directory is listed when the walker reaches it so the read ahead threads do the parsing
+        for dirpath, dirnames, filenames in part.walk_tree(threads = 4):
+            if dirpath == '/':
+                prefix = dirpath
+            else:
+                prefix = dirpath + '/'
+            for filename in [dirpath] + [prefix + name for name in filenames]:
+                fi = part.get_file(filename)
+                if fi.fr:
+                    self.output("File: %s\t%d" % (filename, fi.fr.fsize))
+                    self.output("%s\t%s\t%s\n" % (xboxtime.fat2ctime(fi.fr.mtime, fi.fr.mdate),\
+                                                xboxtime.fat2ctime(fi.fr.atime, fi.fr.adate),\
+                                                xboxtime.fat2ctime(fi.fr.ctime, fi.fr.cdate)))
                                             
     def print_stfs(self, stf):
         """ Prints out information contained in the provided STFS object """
@@ -70,8 +75,8 @@ class Report360:
         self.output("\nFILE LISTING")
         for filename in stf.allfiles:
             fl = stf.allfiles[filename]
-            self.output("%s\t%s\t %d\t %s " % (time.ctime(xboxtime.fat2unixtime(fl.utime, fl.udate)),\
-                                        time.ctime(xboxtime.fat2unixtime(fl.atime, fl.adate)),\
+            self.output("%s\t%s\t %d\t %s " % (xboxtime.fat2ctime(fl.utime, fl.udate),\
+                                        xboxtime.fat2ctime(fl.atime, fl.adate),\
                                         fl.size, filename))
                                     
     def print_xdbf(self, gpd):
@@ -152,7 +157,7 @@ class Report360:
             return
 
         self.output("Opening %s" % self.filename, self.errfd)
-        x = partition.Partition(self.filename)
+        x = partition.Partition(self.filename, threadsafe = True, cache_size = partition.DEFAULT_CACHE_CLUSTERS)
         self.print_xtaf(x)
 
         # Find STFS files
@@ -161,7 +166,7 @@ class Report360:
             try:
                 if xboxmagic.find_type(data = x.read_file(filename, size=0x10)) == "STFS":
                     self.output("Processing STFS file %s" % filename, self.errfd)
-                    s = stfs.STFS(filename, fd=x.open_fd(filename))
+                    s = stfs.STFS(filename, fd=x.open_fd(filename, readahead = partition.DEFAULT_READAHEAD))
                     self.print_stfs(s)
                     
                     # Check to see if this is a gamertag STFS  
@@ -177,8 +182,7 @@ class Report360:
                             # Process GPD files
                             if magic == 'XDBF':
                                 self.output("Processing GPD File %s" % stfsfile, self.errfd)
-                                # Maybe STFS needs an equivalent to Partition.open_fd(filename)
-                                g = xdbf.XDBF(stfsfile, fd=StringIO(s.read_file(s.allfiles[stfsfile])))
+                                g = xdbf.XDBF(stfsfile, fd=s.open_fd(stfsfile))
                                 self.print_xdbf(g)
                                 if self.image_directory != None: # Extract all the images
                                     for gpdimage in g.images:
@@ -207,6 +211,7 @@ class Report360:
             except (IOError, OverflowError, AssertionError) as e: # STFS Error
                 self.output("STFS Error: %s %s %s" % (filename, type(e), e), self.errfd)
                 continue
+        self.output(x.cache, self.errfd)
                         
             
 if __name__ == '__main__':